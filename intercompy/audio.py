@@ -1,15 +1,17 @@
 """
 Capture and play audio for use with Telegram. Uses ffmpeg for recording and vlc for playback.
 """
+import hashlib
 import logging
 import os
-import wave
+import subprocess
+import threading
 from array import array
-from asyncio import sleep
-from struct import pack
+from asyncio import Queue, gather, get_event_loop, sleep
+from io import BytesIO
+from time import monotonic
 from sys import byteorder
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Tuple, Optional
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
 
 import ffmpy
 import speech_recognition as sr
@@ -20,11 +22,26 @@ from pyaudio import PyAudio, paInt16
 from pydub import AudioSegment
 from pydub.silence import split_on_silence
 
-from intercompy.config import Audio
+from intercompy import metrics
+from intercompy.endpoint import Endpointer
+from intercompy.config import (
+    Audio,
+    Config,
+    Encoding,
+    AUDIO_SECTION,
+    ENDPOINTER_ADAPTIVE,
+    POOL_ENCODE,
+    POOL_IO,
+    POOL_NETWORK,
+)
+from intercompy.executors import run_in
+from intercompy.spool import spool_file
 from intercompy.tracing import trace, get_tracer
 
 WAV_FORMAT = paInt16
 WAV_CHUNK_SIZE = 4096
+PLAYBACK_POLL_SECONDS = 0.5
+PLAYBACK_START_POLL_SECONDS = 0.005
 
 logger = logging.getLogger(__name__)
 
@@ -57,50 +74,101 @@ def setup_audio(cfg: Audio):
         record_prompt(prompt, cfg)
 
 
+async def refresh_prompts(cfg: Config, _previous: Config, changed: Set[str]):
+    """
+    After a config reload, render any prompts whose text, language or accent changed.
+    Unchanged prompts are already on disk, so render_prompt() just re-registers them.
+    """
+    if AUDIO_SECTION not in changed:
+        return
+
+    await gather(*[render_prompt(prompt, cfg.audio) for prompt in PROMPTS])
+
+
 @trace
-async def speech_to_text(soundfile: NamedTemporaryFile) -> str:
+async def speech_to_text(soundfile: BytesIO) -> str:
     """
     Transform a recorded voice to text for sending separately, to help in high-noise
     environments on the receiving end
     """
 
-    recognizer = sr.Recognizer()
-    sound = AudioSegment.from_ogg(soundfile.name)
+    chunks = await run_in(POOL_ENCODE, _split_speech, soundfile.getvalue())
+    opentelemetry.trace.get_current_span().set_attribute("speech.chunks", len(chunks))
 
-    chunks = split_on_silence(
+    translation = await gather(*[run_in(POOL_NETWORK, _recognize_chunk, c) for c in chunks])
+
+    return " ".join(translation)
+
+
+def _split_speech(data: bytes) -> list:
+    """Decode a recording and split it into phrases at the pauses"""
+    sound = AudioSegment.from_ogg(BytesIO(data))
+    return split_on_silence(
         sound, min_silence_len=100, silence_thresh=sound.dBFS - 24, keep_silence=100
     )
-    translation = []
-    with TemporaryDirectory("intercom.speech-to-text") as tdname:
-        for i, chunk in enumerate(chunks, start=1):
-            fname = os.path.join(tdname, f"chunk{i}.wav")
-            chunk.export(fname, format="wav")
-
-            with sr.AudioFile(fname) as source:
-                aud = recognizer.record(source)
-                try:
-                    text = recognizer.recognize_google(aud)
-                    translation.append(text)
-                except sr.UnknownValueError as error:
-                    logger.warning("Translation error: %s", error)
-                    translation.append("*garbled*")
 
-    return " ".join(translation)
 
+def _recognize_chunk(chunk: AudioSegment) -> str:
+    """Transcribe one phrase. Each call gets its own recognizer, so phrases can run in parallel."""
+    wav = BytesIO()
+    chunk.export(wav, format="wav")
+    wav.seek(0)
+
+    recognizer = sr.Recognizer()
+    with sr.AudioFile(wav) as source:
+        aud = recognizer.record(source)
+        try:
+            return recognizer.recognize_google(aud)
+        except sr.UnknownValueError as error:
+            logger.warning("Translation error: %s", error)
+            return "*garbled*"
 
-@trace
-def record_prompt(snd: Tuple[str, str], cfg: Audio) -> str:
-    """Record a standard audio prompt for a given text directive, for later use"""
 
+def _render_speech(text: str, cfg: Audio) -> bytes:
+    """Render text to speech in memory. Blocks on the network, so run it on a pool."""
+    speech = BytesIO()
+    tts(text, lang=cfg.text_lang, tld=cfg.text_accent).write_to_fp(speech)
+    return speech.getvalue()
+
+
+def _write_file(fname: str, data: bytes):
+    with open(fname, "wb") as fhandle:
+        fhandle.write(data)
+
+
+def _synthesize(text: str, fname: str, cfg: Audio):
+    """Render text to speech and save it, blocking the calling thread"""
+    _write_file(fname, _render_speech(text, cfg))
+
+
+async def synthesize_to(text: str, fname: str, cfg: Audio):
+    """Render text to speech on the network pool, then write it out on the io pool"""
+    with get_tracer().start_as_current_span("audio.text-to-speech"):
+        speech = await run_in(POOL_NETWORK, _render_speech, text, cfg)
+    await run_in(POOL_IO, _write_file, fname, speech)
+
+
+def _prompt_file(snd: Tuple[str, str], cfg: Audio) -> Tuple[str, str]:
+    """The text of a prompt, and the file it is rendered to"""
     key = snd[0]
+    txt = cfg.prompts.get(key) or snd[1]
 
     prompts_dir = os.path.join(
         cfg.audio_dir, f"prompts-{cfg.text_lang}-{cfg.text_accent}"
     )
-    if not os.path.isdir(prompts_dir):
-        os.makedirs(prompts_dir)
 
-    fname = os.path.join(prompts_dir, f"intercom.prompt.{key}.ogg")
+    # The file name includes a digest of the text, so editing a prompt re-renders it.
+    digest = hashlib.sha1(txt.encode("utf-8")).hexdigest()[:10]
+    return txt, os.path.join(prompts_dir, f"intercom.prompt.{key}.{digest}.ogg")
+
+
+@trace
+def record_prompt(snd: Tuple[str, str], cfg: Audio) -> str:
+    """Record a standard audio prompt for a given text directive, for later use"""
+
+    key = snd[0]
+    txt, fname = _prompt_file(snd, cfg)
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
 
     opentelemetry.trace.get_current_span().set_attributes({
         "recording.key": key,
@@ -110,13 +178,32 @@ def record_prompt(snd: Tuple[str, str], cfg: Audio) -> str:
     if not os.path.exists(fname):
         logger.debug("Generating prompt audio %s at: %s", key, fname)
 
-        prompts = cfg.prompts
-        txt = prompts.get(key) or snd[1]
         with get_tracer().start_as_current_span("audio.text-to-speech"):
-            speech = tts(txt, lang=cfg.text_lang, tld=cfg.text_accent)
+            _synthesize(txt, fname, cfg)
+
+    RECORDINGS[key] = fname
+    return fname
 
-        logger.debug("Saving generated speech data for: %s", key)
-        speech.save(fname)
+
+@trace
+async def render_prompt(snd: Tuple[str, str], cfg: Audio) -> str:
+    """
+    record_prompt() for use on the event loop: file checks and writes run on the io pool,
+    and synthesis on the network pool.
+    """
+    key = snd[0]
+    txt, fname = _prompt_file(snd, cfg)
+    await run_in(POOL_IO, os.makedirs, os.path.dirname(fname), exist_ok=True)
+
+    exists = await run_in(POOL_IO, os.path.exists, fname)
+    opentelemetry.trace.get_current_span().set_attributes({
+        "recording.key": key,
+        "recording.path": fname,
+        "recording.exists": exists
+    })
+    if not exists:
+        logger.debug("Generating prompt audio %s at: %s", key, fname)
+        await synthesize_to(txt, fname, cfg)
 
     RECORDINGS[key] = fname
     return fname
@@ -129,51 +216,62 @@ async def play_prompt_text(snd: Tuple[str, str], cfg: Audio):
     key = snd[0]
     message_file = RECORDINGS.get(key)
     if message_file is None:
-        message_file = record_prompt(snd, cfg)
+        message_file = await render_prompt(snd, cfg)
 
     logger.debug("Playing sound: %s from file: %s", key, message_file)
     await playback_ogg(message_file, cfg)
 
 
 @trace
-async def play_impromptu_text(text: str, cfg: Audio):
-    """Play an impromptu prompt text, without caching the audio file for reuse."""
+async def play_impromptu_text(
+        text: str, cfg: Audio, outputs: Optional[List[Audio]] = None,
+        keep: Optional[Callable[[str], Awaitable[str]]] = None
+):
+    """
+    Play an impromptu prompt text, without caching the audio file for reuse. The text is
+    synthesized once, then played in each of 'outputs' (rooms) at the same time, or just on
+    'cfg' if no outputs are given. If given, 'keep' can claim the synthesized file before it
+    plays (for replay); it returns the path to play from.
+    """
 
-    with NamedTemporaryFile(
-            "wb", prefix="intercom.text.", suffix=".ogg", delete=True
-    ) as msg:
-        with get_tracer().start_as_current_span("audio.text-to-speech"):
-            speech = tts(text, lang=cfg.text_lang, tld=cfg.text_accent)
+    with spool_file("intercom.text.", ".ogg") as fname:
+        with metrics.Timer(metrics.INBOUND_SYNTHESIS):
+            await synthesize_to(text, fname, cfg)
 
-        logger.debug("Saving generated speech data")
-        speech.save(msg.name)
+        if keep is not None:
+            fname = await keep(fname)
 
-        logger.debug("Playing sound for: '%s' from file: %s", text, msg.name)
-        await playback_ogg(msg.name, cfg)
+        logger.debug("Playing sound for: '%s' from file: %s", text, fname)
+        await gather(*[playback_ogg(fname, output) for output in outputs or [cfg]])
 
 
-@trace
-async def record_ogg(cfg: Audio, stop_fn=None) -> NamedTemporaryFile:
-    """Records from the microphone and outputs the resulting data to 'path'"""
+# pylint: disable=too-few-public-methods
+class Recording:
+    """Raw PCM captured from the microphone, along with the format needed to encode it"""
 
-    @trace
-    def to_ogg():
-        opentelemetry.trace.get_current_span().set_attribute("wav-size",
-                                                             os.path.getsize(wavfile.name))
+    def __init__(self, input_info: dict, channels: int, sample_width: int, data: array):
+        self.input_info = input_info
+        self.channels = channels
+        self.sample_width = sample_width
+        self.data = data
+        self.captured_at = monotonic()
 
-        ffmpeg = ffmpy.FFmpeg(
-            inputs={wavfile.name: None}, outputs={oggfile.name: ["-y", "-f", "ogg"]}
-        )
-        ffmpeg.run()
 
-        opentelemetry.trace.get_current_span().set_attribute("ogg-size",
-                                                             os.path.getsize(oggfile.name))
+@trace
+async def record_ogg(cfg: Audio, stop_fn=None) -> BytesIO:
+    """Records from the microphone and returns the encoded voice note"""
+    recording = await capture_voice(cfg, stop_fn)
+    await play_prompt_text(SND_PROCESSING_RECORDING, cfg)
+    return await encode_ogg(recording, cfg)
 
-    # pylint: disable=consider-using-with
-    oggfile = NamedTemporaryFile(
-        "wb", prefix="intercom.voice-out.", suffix=".ogg", delete=False
-    )
 
+@trace
+async def capture_voice(cfg: Audio, stop_fn=None) -> Recording:
+    """
+    Record from the microphone until silence is detected, or until stop_fn returns True. The
+    audio device is released before this returns, so another capture can start while the
+    result is still being encoded.
+    """
     pyaudio = PyAudio()
 
     try:
@@ -190,49 +288,88 @@ async def record_ogg(cfg: Audio, stop_fn=None) -> NamedTemporaryFile:
         pyaudio.terminate()
         print("pyaudio terminated")
 
-    with NamedTemporaryFile(
-            "wb", prefix="intercom.voice-out.", suffix=".wav"
-    ) as wavfile:
-        logger.debug("Packing WAV data")
-        data = pack("<" + ("h" * len(data)), *data)
+    return Recording(input_info, channels, sample_width, data)
+
+
+@trace
+async def encode_ogg(recording: Recording, cfg: Audio) -> BytesIO:
+    """
+    Encode a captured recording as an in-memory .ogg voice note. The recording is downmixed
+    and resampled to the configured encoding first, so ffmpeg only has to compress a small
+    mono stream. PCM is piped to ffmpeg and the result read back, so nothing touches disk.
+    """
+    encoding = cfg.encoding
+
+    @trace
+    def to_ogg(pcm: bytes) -> bytes:
+        opentelemetry.trace.get_current_span().set_attributes({
+            "pcm-size": len(pcm),
+            "encoding.codec": encoding.codec,
+            "encoding.bitrate": encoding.bitrate,
+        })
 
-        logger.info("Writing WAV file")
-        with wave.open(wavfile.name, mode="wb") as _wf:
-            _write_wav(input_info, channels, sample_width, data, _wf)
+        ffmpeg = ffmpy.FFmpeg(
+            inputs={"pipe:0": [
+                "-f", "s16le", "-ar", str(encoding.sample_rate), "-ac", str(encoding.channels)
+            ]},
+            outputs={"pipe:1": encoding.ffmpeg_options()},
+        )
+        ogg, _ = ffmpeg.run(input_data=pcm, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-        await play_prompt_text(SND_PROCESSING_RECORDING, cfg)
+        opentelemetry.trace.get_current_span().set_attribute("ogg-size", len(ogg))
+        return ogg
 
-        logger.info("Converting WAV to OGG")
-        to_ogg()
+    logger.debug("Converting PCM to %d channel(s) at %dHz", encoding.channels,
+                 encoding.sample_rate)
+    pcm = await run_in(POOL_ENCODE, _convert_pcm, recording, encoding)
 
-        logger.info("OGG file recorded to: %s", oggfile.name)
+    logger.info("Encoding voice note")
+    oggfile = BytesIO(await run_in(POOL_ENCODE, to_ogg, pcm))
+    # Pyrogram uploads in-memory files under this name.
+    oggfile.name = "voice.ogg"
 
-        return oggfile
+    logger.info("Voice note encoded: %d bytes", len(oggfile.getvalue()))
+    return oggfile
 
 
 @trace
-async def playback_ogg(filename: str, cfg: Audio, vol_override: Optional[int] = None):
-    """Play an .ogg file"""
+async def playback_ogg(
+        filename: str, cfg: Audio, vol_override: Optional[int] = None,
+        on_started: Optional[Callable[[], None]] = None
+):
+    """
+    Play an .ogg file. The player is polled closely until VLC reports that playback has begun,
+    so the time to audio start is measured accurately; 'on_started', if given, is called then.
+    """
     opentelemetry.trace.get_current_span().set_attribute("ogg-size", os.path.getsize(filename))
 
     vol = vol_override or cfg.volume
 
     _v = vlc.Instance("--aout=alsa")
     _p = _v.media_player_new()
+    if cfg.output_device is not None:
+        _p.audio_output_device_set(None, str(cfg.output_device))
     vlc.libvlc_audio_set_volume(_p, vol)
 
     _m = _v.media_new(filename)
     _p.set_media(_m)
     _p.play()
 
+    started = False
     finished = False
     while not finished:
         state = _p.get_state()
+        if not started and state in (vlc.State.Playing, vlc.State.Ended):
+            started = True
+            metrics.audio_started()
+            if on_started is not None:
+                on_started()
+
         if state in (vlc.State.Ended, vlc.State.Error, vlc.State.Stopped):
             opentelemetry.trace.get_current_span().set_attribute("vlc-end-state", state)
             finished = True
 
-        await sleep(0.5)
+        await sleep(PLAYBACK_POLL_SECONDS if started else PLAYBACK_START_POLL_SECONDS)
 
 
 def _is_silent(snd_data: array, cfg: Audio) -> bool:
@@ -240,38 +377,26 @@ def _is_silent(snd_data: array, cfg: Audio) -> bool:
     return max(snd_data) < cfg.wav_threshold
 
 
-def _trim(snd_data: array, cfg: Audio) -> array:
+def _trim(snd_data: array, cfg: Audio, channels: int = 1) -> array:
     """Trim the blank spots at the start and end"""
 
-    # Trim to the left
-    logger.info("Trimming WAV (left side) from: %d frames", len(snd_data))
-    snd_started = False
-    end = len(snd_data)
-    i = 0
-    while i < end:
-        if not snd_started:
-            if abs(i) > cfg.wav_threshold:
-                snd_started = True
-            else:
-                snd_data.remove(i)
-
-        i += 1
+    logger.info("Trimming WAV from: %d samples", len(snd_data))
+    threshold = cfg.wav_threshold
 
-    # Trim to the right
-    logger.info("Trimming WAV (right side) from: %d frames", len(snd_data))
-    snd_started = False
-    i = len(snd_data) - 1
-    while i >= 0:
-        if not snd_started:
-            if abs(i) > cfg.wav_threshold:
-                snd_started = True
-            else:
-                snd_data.remove(i)
+    start = 0
+    end = len(snd_data)
+    while start < end and abs(snd_data[start]) <= threshold:
+        start += 1
+    while end > start and abs(snd_data[end - 1]) <= threshold:
+        end -= 1
 
-        i -= 1
+    # Keep whole frames, so interleaved channels stay aligned.
+    start -= start % channels
+    end += (channels - end % channels) % channels
 
-    logger.info("Resulting recording has %d frames", len(snd_data))
-    return snd_data
+    trimmed = snd_data[start:end]
+    logger.info("Resulting recording has %d samples", len(trimmed))
+    return trimmed
 
 
 def _is_valid_input(dev) -> bool:
@@ -281,8 +406,37 @@ def _is_valid_input(dev) -> bool:
     return 0 < in_channels < 3
 
 
+def _input_by_index(pyaudio: PyAudio, index: int, device_count: int) -> Optional[dict]:
+    """The configured input device, if it exists and can record voice"""
+    if not 0 <= index < device_count:
+        logger.error("Configured input device %s does not exist", index)
+        return None
+
+    dev = pyaudio.get_device_info_by_index(index)
+    if not _is_valid_input(dev):
+        logger.error("Configured input device %s is INVALID! Info:\n\n%s", index, dev)
+        return None
+
+    return dev
+
+
+def _input_by_name(pyaudio: PyAudio, name: Optional[str], device_count: int) -> Optional[dict]:
+    """The first input device that can record voice, with the given name if there is one"""
+    if name is None:
+        logger.info("Selecting a candidate input device from the list...")
+    else:
+        logger.info("Looking for input device named: %s", name)
+
+    for idx in range(device_count):
+        dev = pyaudio.get_device_info_by_index(idx)
+        if _is_valid_input(dev) and (name is None or dev["name"] == name):
+            return dev
+
+    return None
+
+
 @trace
-def _detect_input(pyaudio: PyAudio, cfg: Audio) -> dict:
+def _detect_input(pyaudio: PyAudio, cfg: Audio) -> Optional[dict]:
     """
     Find the audio input device
     """
@@ -299,32 +453,19 @@ def _detect_input(pyaudio: PyAudio, cfg: Audio) -> dict:
                                                              cfg.audio_device)
         device_index = device
 
-    input_info = pyaudio.get_default_input_device_info()
     device_count = pyaudio.get_device_count()
-
     opentelemetry.trace.get_current_span().set_attribute("audio-device-count", device_count)
 
-    if (
-            input_info is None
-            and device_index is not None
-            and device_index < device_count - 1
-    ):
-        dev = pyaudio.get_device_info_by_index(int(device_index))
-        if _is_valid_input(dev):
-            input_info = dev
-        else:
-            logger.error(
-                "Configured input device %s is INVALID! Info:\n\n%s", device_index, dev
-            )
-
-    if input_info is None:
-        logger.info("Selecting a candidate input device from the list...")
-        for idx in range(device_count):
-            dev = pyaudio.get_device_info_by_index(idx)
-            if _is_valid_input(dev):
-                if device_name is None or dev["name"] == device_name:
-                    input_info = dev
-                    break
+    # In multi-room mode, each room names its own device, so the system default is only used
+    # when no device is configured.
+    if device_index is not None:
+        input_info = _input_by_index(pyaudio, int(device_index), device_count)
+    elif device_name is not None:
+        input_info = _input_by_name(pyaudio, device_name, device_count)
+    else:
+        input_info = pyaudio.get_default_input_device_info()
+        if input_info is None:
+            input_info = _input_by_name(pyaudio, None, device_count)
 
     if input_info is None:
         opentelemetry.trace.get_current_span().set_attribute("detected-input", 0)
@@ -345,16 +486,21 @@ async def _record_wav(
     Record a word or words from the microphone and
     return the data as an array of signed shorts.
 
-    Normalizes the audio, trims silence from the
-    start and end, and pads with 0.5 seconds of
-    blank sound to make sure VLC et al can play
-    it without getting chopped off.
+    With the adaptive endpointer (the default), recording ends once speech has fallen back to
+    the room's noise floor for 'hangover-ms', and the result is cut down to the speech plus a
+    short pad. With the fixed endpointer, it ends after 'wav-silence-threshold' chunks below
+    'wav-threshold', and silence is trimmed from the start and end.
     """
+    rate = int(input_info.get("defaultSampleRate"))
+    endpointer = new_endpointer(cfg, rate, channels)
+
     opentelemetry.trace.get_current_span().set_attributes({
         "wav-format": WAV_FORMAT,
         "wav-chunk-size": WAV_CHUNK_SIZE,
+        "endpointer": cfg.endpointer,
         "wav-audible-threshold": cfg.wav_threshold,
         "wav-silent-frame-threshold": cfg.wav_silence_threshold,
+        "hangover-ms": cfg.hangover_ms,
         "audio-device": int(input_info.get("index")),
         "channels": channels,
         "stop-fn": "None" if stop_fn is None else str(stop_fn)
@@ -365,55 +511,47 @@ async def _record_wav(
         stream = pyaudio.open(
             format=WAV_FORMAT,
             channels=channels,
-            rate=int(input_info.get("defaultSampleRate")),
+            rate=rate,
             input_device_index=int(input_info.get("index")),
             input=True,
             frames_per_buffer=WAV_CHUNK_SIZE,
         )
 
-        num_silent = 0
-        snd_started = False
-
         _r = array("h")
 
         logger.info("Detecting voice message")
-        while True:
-            # little endian, signed short
-            snd_data = array("h", stream.read(WAV_CHUNK_SIZE, exception_on_overflow=False))
-            if byteorder == "big":
-                snd_data.byteswap()
-            _r.extend(snd_data)
-
-            silent = _is_silent(snd_data, cfg)
-
-            if silent:
-                if snd_started:
-                    num_silent += 1
-            else:
-                if not snd_started:
-                    snd_started = True
-                else:
-                    # We're resetting here, since we want to count CONSECUTIVE silent samples
-                    num_silent = 0
-
-            if snd_started:
-                if stop_fn is not None:
-                    if await stop_fn():
-                        logger.info(
-                            "Got the recording based on stop_fn. Formatting / returning"
-                        )
-                        break
-                elif num_silent > cfg.wav_silence_threshold:
+        # Reads block until a chunk is ready, so the stream is read on a thread of its own.
+        # That keeps button presses and Telegram updates flowing, and lets each room capture
+        # without waiting on a shared pool.
+        reader = MicrophoneReader(stream, f"intercom-capture-{input_info.get('index')}")
+        reader.start()
+        try:
+            while True:
+                chunk = await reader.read()
+
+                # little endian, signed short
+                snd_data = array("h", chunk)
+                if byteorder == "big":
+                    snd_data.byteswap()
+                _r.extend(snd_data)
+
+                ended = endpointer.feed(snd_data)
+
+                if stop_fn is not None and await stop_fn():
                     logger.info(
-                        "Got the recording based on silence. Formatting / returning"
+                        "Got the recording based on stop_fn. Formatting / returning"
                     )
                     break
 
-        opentelemetry.trace.get_current_span().set_attributes({
-            "wav-silent-frame-count": num_silent,
-            "wav-sound-detected": snd_started
-        })
+                if ended:
+                    logger.info(
+                        "Got the recording based on silence. Formatting / returning"
+                    )
+                    break
+        finally:
+            await reader.stop()
 
+        opentelemetry.trace.get_current_span().set_attributes(endpointer.span_attributes())
         logger.info("Finished capturing voice message")
 
         sample_width = pyaudio.get_sample_size(WAV_FORMAT)
@@ -422,7 +560,7 @@ async def _record_wav(
         stream.stop_stream()
         stream.close()
 
-        _r = _trim(_r, cfg)
+        _r = endpointer.trim(_r)
         logger.info("audio sample has been trimmed to %d frames", len(_r))
         return sample_width, _r
     except ValueError as error:
@@ -432,15 +570,122 @@ async def _record_wav(
         })
 
 
-def _write_wav(
-        input_info: dict,
-        channels: int,
-        sample_width: int,
-        data: bytes,
-        _wf: wave.Wave_write,
-):
-    """Take input from device recording (in memory) and write it to a WAV file"""
-    _wf.setnchannels(channels)
-    _wf.setsampwidth(sample_width)
-    _wf.setframerate(int(input_info.get("defaultSampleRate")))
-    _wf.writeframes(data)
+class MicrophoneReader:
+    """
+    Read an input stream chunk by chunk on a dedicated thread, handing each chunk to the event
+    loop in order. Reading stops, and the thread exits, once stop() is awaited.
+    """
+
+    def __init__(self, stream, name: str):
+        self.stream = stream
+        self.loop = get_event_loop()
+        self.chunks: Queue = Queue()
+        self.stopped = self.loop.create_future()
+        self._running = True
+        self._thread = threading.Thread(target=self._read, name=name, daemon=True)
+
+    def start(self):
+        """Start reading"""
+        self._thread.start()
+
+    async def read(self) -> bytes:
+        """The next chunk from the stream. Raises whatever error ended the reading."""
+        chunk = await self.chunks.get()
+        if isinstance(chunk, Exception):
+            raise chunk
+
+        return chunk
+
+    async def stop(self):
+        """Stop reading, waiting for any read in progress to finish"""
+        self._running = False
+        await self.stopped
+
+    def _read(self):
+        try:
+            while self._running:
+                chunk = self.stream.read(WAV_CHUNK_SIZE, exception_on_overflow=False)
+                self.loop.call_soon_threadsafe(self.chunks.put_nowait, chunk)
+        except Exception as error:  # pylint: disable=broad-except
+            self.loop.call_soon_threadsafe(self.chunks.put_nowait, error)
+        finally:
+            self.loop.call_soon_threadsafe(self.stopped.set_result, None)
+
+
+def new_endpointer(cfg: Audio, rate: int, channels: int):
+    """The configured end-of-message detector for a recording"""
+    if cfg.endpointer == ENDPOINTER_ADAPTIVE:
+        return Endpointer(cfg, rate, channels)
+
+    return FixedEndpointer(cfg, channels)
+
+
+class FixedEndpointer:
+    """
+    The original end-of-message rule, with the same interface as the adaptive Endpointer:
+    the message ends after 'wav-silence-threshold' consecutive chunks below 'wav-threshold'.
+    """
+
+    def __init__(self, cfg: Audio, channels: int):
+        self.cfg = cfg
+        self.channels = channels
+        self.num_silent = 0
+        self.heard_speech = False
+
+    def feed(self, samples: array) -> bool:
+        """Analyze the next chunk of samples. Returns True once the message has ended."""
+        if _is_silent(samples, self.cfg):
+            if self.heard_speech:
+                self.num_silent += 1
+        elif not self.heard_speech:
+            self.heard_speech = True
+        else:
+            # We're resetting here, since we want to count CONSECUTIVE silent samples
+            self.num_silent = 0
+
+        return self.heard_speech and self.num_silent > self.cfg.wav_silence_threshold
+
+    def trim(self, samples: array) -> array:
+        """Trim the silence from the start and end of a recording"""
+        return _trim(samples, self.cfg, self.channels)
+
+    def span_attributes(self) -> dict:
+        """Describe how the recording ended, for tracing"""
+        return {
+            "wav-silent-frame-count": self.num_silent,
+            "wav-sound-detected": self.heard_speech,
+        }
+
+
+def _pack_samples(samples: array) -> bytes:
+    """Serialize samples as little-endian signed shorts"""
+    if byteorder == "big":
+        samples = array("h", samples)
+        samples.byteswap()
+
+    return samples.tobytes()
+
+
+@trace
+def _convert_pcm(recording: Recording, encoding: Encoding) -> bytes:
+    """Downmix and resample a recording to the encoding's channel count and sample rate"""
+    rate = int(recording.input_info.get("defaultSampleRate"))
+    segment = AudioSegment(
+        data=_pack_samples(recording.data),
+        sample_width=recording.sample_width,
+        frame_rate=rate,
+        channels=recording.channels,
+    )
+
+    if segment.channels != encoding.channels:
+        segment = segment.set_channels(encoding.channels)
+    if segment.frame_rate != encoding.sample_rate:
+        segment = segment.set_frame_rate(encoding.sample_rate)
+
+    opentelemetry.trace.get_current_span().set_attributes({
+        "input.channels": recording.channels,
+        "input.sample-rate": rate,
+        "output.channels": segment.channels,
+        "output.sample-rate": segment.frame_rate,
+    })
+    return segment.raw_data
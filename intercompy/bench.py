@@ -0,0 +1,216 @@
+"""
+Benchmarks for the audio pipeline, runnable on a plain Linux box (ffmpeg still required).
+
+Hardware and network are replaced with the stand-ins in intercompy.fakes; speech recognition
+uses a stub recognizer. Results are written as JSON so they can be compared between commits.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from asyncio import new_event_loop
+from contextlib import ExitStack
+from statistics import mean, median
+from typing import Callable, Dict, List, Optional
+from unittest import mock
+
+import click
+
+from intercompy import audio, convo, text
+from intercompy.config import Config
+from intercompy.fakes import (
+    FakeClient,
+    FakePyAudio,
+    FakeVlc,
+    install_fake_prompts,
+)
+from intercompy.testsignal import synthetic_speech
+
+# pylint: disable=protected-access
+
+BENCH_RATE = 16000
+BENCH_TEXT = (
+    "Running late!!! Be home at 7. Check https://example.com/traffic?from=home for the mess "
+    "on the highway 🚗🚗🚗 or call 5551234567 😂👍🏽"
+)
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Reduce a list of per-iteration durations (ms) to summary statistics"""
+    ordered = sorted(samples)
+    return {
+        "iterations": len(ordered),
+        "min_ms": round(ordered[0], 3),
+        "median_ms": round(median(ordered), 3),
+        "mean_ms": round(mean(ordered), 3),
+        "p95_ms": round(ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)], 3),
+        "max_ms": round(ordered[-1], 3),
+    }
+
+
+def measure(func: Callable, iterations: int) -> Dict[str, float]:
+    """Time 'func' over the given number of iterations"""
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000.0)
+
+    return summarize(samples)
+
+
+class Bench:
+    """Shared fixtures for the audio benchmarks"""
+
+    def __init__(self, workdir: str, iterations: int):
+        self.workdir = workdir
+        self.iterations = iterations
+        self.loop = new_event_loop()
+        self.pcm = synthetic_speech(BENCH_RATE)
+        self.cfg = Config(
+            {"audio": {"wav-silence-threshold": 4}, "telegram": {"chat": "bench"}}, workdir
+        )
+        self.vlc = FakeVlc()
+        self._patches = ExitStack()
+
+    def __enter__(self):
+        patches = self._patches
+        patches.enter_context(mock.patch.object(audio, "PyAudio", FakePyAudio(self.pcm)))
+        patches.enter_context(mock.patch.object(audio, "vlc", self.vlc))
+        patches.enter_context(
+            mock.patch.object(audio.sr.Recognizer, "recognize_google", _stub_recognize)
+        )
+
+        install_fake_prompts(self.workdir, audio.PROMPTS)
+
+        return self
+
+    def __exit__(self, *exc):
+        self._patches.close()
+        self.loop.close()
+
+    def run(self, coro):
+        """Run a coroutine to completion"""
+        return self.loop.run_until_complete(coro)
+
+    def is_silent(self) -> Dict[str, float]:
+        """_is_silent over every 4096-sample chunk of the synthetic utterance"""
+        chunks = [
+            self.pcm[i:i + audio.WAV_CHUNK_SIZE]
+            for i in range(0, len(self.pcm), audio.WAV_CHUNK_SIZE)
+        ]
+        return measure(lambda: [audio._is_silent(c, self.cfg.audio) for c in chunks],
+                       self.iterations)
+
+    def trim(self) -> Dict[str, float]:
+        """_trim on the synthetic utterance"""
+        return measure(lambda: audio._trim(array("h", self.pcm), self.cfg.audio),
+                       self.iterations)
+
+    def record_wav(self) -> Dict[str, float]:
+        """_record_wav end-to-end, reading from the fake input as fast as it can"""
+        pyaudio = audio.PyAudio()
+        info = pyaudio.get_default_input_device_info()
+        return measure(
+            lambda: self.run(audio._record_wav(pyaudio, info, self.cfg.audio, 1)),
+            self.iterations,
+        )
+
+    def encode_ogg(self) -> Dict[str, float]:
+        """WAV -> OGG conversion of a captured recording"""
+        recording = self.run(audio.capture_voice(self.cfg.audio))
+        return measure(lambda: self.run(audio.encode_ogg(recording, self.cfg.audio)),
+                       self.iterations)
+
+    def speech_to_text(self) -> Dict[str, float]:
+        """speech_to_text chunking and recognition, using the stub recognizer"""
+        recording = self.run(audio.capture_voice(self.cfg.audio))
+        oggfile = self.run(audio.encode_ogg(recording, self.cfg.audio))
+
+        return measure(lambda: self.run(audio.speech_to_text(oggfile)), self.iterations)
+
+    def normalize_text(self) -> Dict[str, float]:
+        """Text-to-speech normalization of an inbound text message"""
+        return measure(lambda: self.run(text.format_inbound_message_for_speech(
+            BENCH_TEXT, self.cfg.audio
+        )), self.iterations)
+
+    def record_and_send(self) -> Dict[str, float]:
+        """The whole outbound path, prompts included, against a fake Telegram client"""
+        client = FakeClient()
+        return measure(
+            lambda: self.run(convo.record_and_send("@bench", client, self.cfg)),
+            self.iterations,
+        )
+
+
+BENCHMARKS = {
+    "is_silent": Bench.is_silent,
+    "trim": Bench.trim,
+    "record_wav": Bench.record_wav,
+    "encode_ogg": Bench.encode_ogg,
+    "speech_to_text": Bench.speech_to_text,
+    "normalize_text": Bench.normalize_text,
+    "record_and_send": Bench.record_and_send,
+}
+
+
+def _stub_recognize(_recognizer, _audio_data, **_kwargs) -> str:
+    return "hello"
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_benchmarks(names: List[str], iterations: int) -> dict:
+    """Run the named benchmarks and return the results as a JSON-ready dict"""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="intercom.bench.") as workdir, \
+            Bench(workdir, iterations) as bench:
+        for name in names:
+            print(f"Running benchmark: {name}", file=sys.stderr)
+            results[name] = BENCHMARKS[name](bench)
+
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": results,
+    }
+
+
+def write_report(report: dict, output: Optional[str] = None):
+    """Write a report as JSON to the 'output' file, or to stdout"""
+    content = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as fhandle:
+            fhandle.write(content)
+    else:
+        print(content)
+
+
+@click.command()
+@click.option("--iterations", "-n", default=10, help="Iterations per benchmark")
+@click.option("--output", "-o", help="Write JSON results to this file instead of stdout")
+@click.option(
+    "--only", multiple=True, type=click.Choice(list(BENCHMARKS)),
+    help="Run only the named benchmark(s)"
+)
+def run(iterations: int = 10, output: str = None, only: List[str] = None):
+    """Benchmark the audio pipeline with hardware and network stand-ins"""
+    report = run_benchmarks(list(only) or list(BENCHMARKS), iterations)
+
+    write_report(report, output)
@@ -1,20 +1,35 @@
 """Command-line interface for intercompy"""
 import logging
+import sys
 from asyncio import gather, new_event_loop, set_event_loop
 
 import click
 
 from intercompy import selftest
-from intercompy.audio import setup_audio
-from intercompy.config import load_config, Config
+from intercompy.audio import setup_audio, refresh_prompts
+from intercompy.config import load_config, watch_config, Config, RESTART_SECTIONS
 from intercompy.convo import start_telegram, setup_telegram
+from intercompy.executors import setup_executors, resize_executors
 from intercompy.gpio import init_pins, listen_for_pins
+from intercompy.metrics import setup_metrics
+from intercompy.replay import setup_replay
+from intercompy.spool import setup_spool
 from intercompy.tracing import setup_tracing, trace, get_tracer
 from intercompy.util import setup_session
+from intercompy.watchdog import Watchdog, DEFAULT_STALL_THRESHOLD_MS
 
+logger = logging.getLogger(__name__)
 
-def _boot(config_file: str = None, debug: bool = False) -> Config:
-    """Read configuration, setup debug/normal logging. Part of all commands."""
+# Exit status when a config change needs a restart; systemd (Restart=on-failure) restarts us.
+RESTART_EXIT_CODE = 3
+
+
+def _boot(config_file: str = None, debug: bool = False, clean: bool = False) -> Config:
+    """
+    Read configuration, setup debug/normal logging. Part of all commands. Only the intercom
+    itself passes 'clean', to empty the spool and replay cache: utility commands can run
+    alongside the service, and must leave its files alone.
+    """
 
     log_level = logging.INFO
     if debug:
@@ -29,6 +44,11 @@ def _boot(config_file: str = None, debug: bool = False) -> Config:
 
     print("Setting up Opentelemetry tracing")
     setup_tracing(cfg.tracing)
+    setup_metrics(cfg.tracing)
+
+    setup_executors(cfg.workers)
+    setup_spool(cfg.spool, clean)
+    setup_replay(cfg.replay, clean)
 
     print("Intercompy boot-up complete. Application will now start...")
     return cfg
@@ -51,26 +71,79 @@ def selftest_gpio(config_file: str = None):
     selftest.test_gpio(cfg)
 
 
+@click.command()
+@click.option("--config-file", "-f", help="Alternative config YAML")
+@click.option("--room", "-r", help="Test this room's devices (default: the first room)")
+@click.option("--iterations", "-n", default=3, help="Repetitions of each measurement")
+@click.option("--output", "-o", help="Write the JSON report here (default: selftest.output)")
+def selftest_audio(
+        config_file: str = None, room: str = None, iterations: int = 3, output: str = None
+):
+    """
+    Measure audio latencies on this device. Exits non-zero if a measurement fails or exceeds
+    its budget in the selftest config section.
+    """
+    cfg = _boot(config_file, False)
+    passed = selftest.test_audio(cfg, room, iterations, output)
+    sys.exit(0 if passed else 1)
+
+
+# pylint: disable=too-many-arguments
 @click.command()
 @click.option("--config-file", "-f", help="Alternative config YAML")
 @click.option("--debug", "-d", is_flag=True, help="Turn on debug logging")
-def run(config_file: str = None, debug: bool = False):
+@click.option(
+    "--watchdog", "-w", is_flag=True,
+    help="Report the stack of any call that blocks the event loop"
+)
+@click.option(
+    "--stall-threshold", default=DEFAULT_STALL_THRESHOLD_MS,
+    help="Milliseconds the event loop may be blocked before the watchdog reports it"
+)
+@click.option(
+    "--watch-config", "watch_config_file", is_flag=True,
+    help="Apply changes to the config file without restarting"
+)
+def run(
+        config_file: str = None, debug: bool = False, watchdog: bool = False,
+        stall_threshold: int = DEFAULT_STALL_THRESHOLD_MS, watch_config_file: bool = False
+):
     """Start the bot listening for intercom messages"""
     loop = new_event_loop()
     set_event_loop(loop)
 
-    cfg = _boot(config_file, debug)
+    cfg = _boot(config_file, debug, clean=True)
+
+    if watchdog:
+        Watchdog(loop, stall_threshold).start()
 
     with get_tracer().start_as_current_span("intercom-start"):
         print("Setting up Telegram client")
         app = setup_telegram(cfg)
 
         print("Setting up hardware buttons")
-        init_pins(cfg.rolodex)
+        init_pins(cfg)
 
         print("Setting up audio prompts")
         setup_audio(cfg.audio)
 
+    restart = []
+    if watch_config_file:
+        cfg.add_listener(refresh_prompts)
+        cfg.add_listener(resize_executors)
+
+        async def restart_for_startup_sections(_cfg: Config, _previous: Config, changed: set):
+            sections = sorted(changed.intersection(RESTART_SECTIONS))
+            if sections:
+                logger.warning("Exiting to restart with changes to: %s", ", ".join(sections))
+                restart.extend(sections)
+                loop.stop()
+
+        cfg.add_listener(restart_for_startup_sections)
+        loop.create_task(watch_config(cfg))
+
     gather(start_telegram(app, cfg), listen_for_pins(app, cfg, loop))
 
     loop.run_forever()
+    if restart:
+        sys.exit(RESTART_EXIT_CODE)
@@ -1,7 +1,11 @@
 """Handle configuration for intercompy bot"""
 import logging
 import os
-from typing import Optional, List
+import tempfile
+from asyncio import sleep
+from copy import copy
+from types import MappingProxyType
+from typing import Awaitable, Callable, NamedTuple, Optional, List, Set, Tuple, Union
 
 from ruamel.yaml import YAML
 
@@ -15,9 +19,29 @@ HOME_CONFIG_FILE = os.path.join(
 APP_STATE_DIR = os.path.join(os.environ.get("HOME"), ".local/state/intercompy")
 
 ROLODEX = "rolodex"
+PIN = "pin"
+ALIAS = "alias"
+TELEGRAM_ID = "id"
+USER_ID = "user-id"
+USERNAME = "username"
+VOLUME_OVERRIDE = "volume"
+TARGETS = "targets"
+MODALITY = "modality"
+IS_INTERCOM = "intercom"
+
+MODALITY_VOICE = "voice"
+MODALITY_TEXT = "text"
+MODALITY_BOTH = "both"
+MODALITIES = (MODALITY_VOICE, MODALITY_TEXT, MODALITY_BOTH)
 
 TELEGRAM_SECTION = "telegram"
 TELEGRAM_SESSION_FILE = "telegram.session"
+TELEGRAM_SESSION_STORAGE = "session-storage"
+# Pyrogram appends '.session' to the name of a file-backed store
+TELEGRAM_SESSION_DB = "telegram-storage"
+
+SESSION_STORAGE_STRING = "string"
+SESSION_STORAGE_FILE = "file"
 
 SESSION = "session"
 ACCOUNT_NAME = "account-name"
@@ -31,20 +55,141 @@ WAV_THRESHOLD = "wav-threshold"
 WAV_SILENCE_THRESHOLD = "wav-silence-threshold"
 VOLUME = "playback-volume"
 AUDIO_DEVICE = "device"
+AUDIO_OUTPUT_DEVICE = "output-device"
 TEXT_LANGUAGE = "text-language"
 TEXT_ACCENT = "text-accent"
 AUDIO_PROMPTS = "prompts"
+AUDIO_ENCODING = "encoding"
+
+ENDPOINTER = "endpointer"
+ENDPOINTER_ADAPTIVE = "adaptive"
+ENDPOINTER_FIXED = "fixed"
+HANGOVER_MS = "hangover-ms"
+SPEECH_START_DB = "speech-start-db"
+SPEECH_END_DB = "speech-end-db"
+SPEECH_MIN_LEVEL = "speech-min-level"
+NOISE_ADAPT_MS = "noise-adapt-ms"
+MAX_RECORD_MS = "max-record-ms"
+
+ENCODING_CODEC = "codec"
+ENCODING_SAMPLE_RATE = "sample-rate"
+ENCODING_CHANNELS = "channels"
+ENCODING_BITRATE = "bitrate"
+ENCODING_VBR = "vbr"
+ENCODING_APPLICATION = "application"
+
+CODEC_OPUS = "libopus"
+OPUS_SAMPLE_RATES = (16000, 24000, 48000)
 
 TEXT_MESSAGE_LINE_ENDING = "text-message-line-ending"
+TEXT_MESSAGE_MAX_LENGTH = "text-message-max-length"
+TEXT_MESSAGE_EMOJI = "text-message-emoji"
+
+EMOJI_NAME = "name"
+EMOJI_REMOVE = "remove"
 
 GPIO_SECTION = "pin-targets"
 
+BUTTONS_SECTION = "buttons"
+BUTTONS_BACKEND = "backend"
+BUTTONS_DEBOUNCE = "debounce-ms"
+BUTTONS_BUSY_POLICY = "busy-policy"
+BUTTONS_QUEUE_SIZE = "queue-size"
+BUTTONS_LONG_PRESS = "long-press-ms"
+
+BUSY_POLICY_QUEUE = "queue"
+BUSY_POLICY_REJECT = "reject"
+
+BUTTONS_BACKEND_RPI = "rpi"
+BUTTONS_BACKEND_FAKE = "fake"
+
+ROOMS_SECTION = "rooms"
+ROOM_AUDIO = "audio"
+ROOM_ROLODEX = "rolodex"
+DEFAULT_ROOM = "default"
+
+WORKERS_SECTION = "workers"
+
+POOL_NETWORK = "network"
+POOL_ENCODE = "encode"
+POOL_IO = "io"
+
+SELFTEST_SECTION = "selftest"
+SELFTEST_BUDGETS = "budgets"
+SELFTEST_OUTPUT = "output"
+
+SPOOL_SECTION = "spool"
+SPOOL_DIR = "dir"
+SPOOL_MAX_BYTES = "max-bytes"
+
+REPLAY_SECTION = "replay"
+REPLAY_DIR = "dir"
+REPLAY_MAX_MESSAGES = "max-messages"
+REPLAY_MAX_BYTES = "max-bytes"
+
 TRACING_SECTION = "tracing"
 TRACING_INTERCOM_NAME = "intercom-name"
+TRACING_ENABLED = "enabled"
+TRACING_SAMPLE_RATE = "sample-rate"
+TRACING_EXPORTER = "exporter"
+TRACING_ENDPOINT = "endpoint"
+TRACING_FILE = "file"
+TRACING_FILE_MAX_BYTES = "file-max-bytes"
+TRACING_FILE_BACKUPS = "file-backups"
+TRACING_MAX_QUEUE_SIZE = "max-queue-size"
+TRACING_MAX_EXPORT_BATCH_SIZE = "max-export-batch-size"
+TRACING_EXPORT_DELAY = "export-delay-ms"
+TRACING_EXPORT_TIMEOUT = "export-timeout-ms"
+TRACING_METRICS_FILE = "metrics-file"
+TRACING_METRICS_INTERVAL = "metrics-interval-ms"
+TRACING_METRICS_SAMPLES = "metrics-samples"
+
+EXPORTER_OTLP = "otlp"
+EXPORTER_FILE = "file"
+EXPORTER_CONSOLE = "console"
+EXPORTER_NONE = "none"
+EXPORTERS = (EXPORTER_OTLP, EXPORTER_FILE, EXPORTER_CONSOLE, EXPORTER_NONE)
+
+DEFAULT_OTLP_ENDPOINT = "https://api.honeycomb.io"
+OTLP_TRACES = "traces"
+OTLP_METRICS = "metrics"
+OTLP_SIGNALS = (OTLP_TRACES, OTLP_METRICS)
+DEFAULT_TRACES_FILE = "traces.jsonl"
+DEFAULT_TELEMETRY_FILE_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_TELEMETRY_FILE_BACKUPS = 3
+DEFAULT_MAX_QUEUE_SIZE = 512
+DEFAULT_MAX_EXPORT_BATCH_SIZE = 128
+DEFAULT_EXPORT_DELAY_MS = 5000
+DEFAULT_EXPORT_TIMEOUT_MS = 10000
+DEFAULT_METRICS_FILE = "metrics.jsonl"
+DEFAULT_METRICS_INTERVAL_MS = 60000
+DEFAULT_METRICS_SAMPLES = 500
 
 DEFAULT_VOLUME = 100
 DEFAULT_WAV_THRESHOLD = 1000
 DEFAULT_WAV_SILENCE_THRESHOLD = 30
+DEFAULT_HANGOVER_MS = 1000
+DEFAULT_SPEECH_START_DB = 12.0
+DEFAULT_SPEECH_END_DB = 6.0
+DEFAULT_SPEECH_MIN_LEVEL = 300
+DEFAULT_NOISE_ADAPT_MS = 1500
+DEFAULT_MAX_RECORD_MS = 60000
+DEFAULT_TEXT_MESSAGE_MAX_LENGTH = 400
+DEFAULT_DEBOUNCE_MS = 200
+DEFAULT_NETWORK_WORKERS = 4
+DEFAULT_IO_WORKERS = 2
+DEFAULT_BUTTON_QUEUE_SIZE = 3
+DEFAULT_SPOOL_DIR = (
+    "/dev/shm/intercompy" if os.path.isdir("/dev/shm")
+    else os.path.join(tempfile.gettempdir(), "intercompy")
+)
+DEFAULT_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_REPLAY_MAX_MESSAGES = 10
+DEFAULT_REPLAY_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_ENCODING_SAMPLE_RATE = 16000
+DEFAULT_ENCODING_BITRATE = "24k"
+DEFAULT_ENCODING_VBR = "on"
+DEFAULT_ENCODING_APPLICATION = "voip"
 
 
 # pylint: disable=too-few-public-methods
@@ -69,6 +214,24 @@ class Audio:
         )
         self.wav_silence_threshold = int(self.wav_silence_threshold)
 
+        self.endpointer = data.get(ENDPOINTER) or ENDPOINTER_ADAPTIVE
+        if self.endpointer not in (ENDPOINTER_ADAPTIVE, ENDPOINTER_FIXED):
+            logger.warning("Unknown endpointer '%s'. Using '%s'.", self.endpointer,
+                           ENDPOINTER_ADAPTIVE)
+            self.endpointer = ENDPOINTER_ADAPTIVE
+
+        self.hangover_ms = int(data.get(HANGOVER_MS) or DEFAULT_HANGOVER_MS)
+        self.speech_start_db = float(data.get(SPEECH_START_DB) or DEFAULT_SPEECH_START_DB)
+        self.speech_end_db = float(data.get(SPEECH_END_DB) or DEFAULT_SPEECH_END_DB)
+        if self.speech_end_db > self.speech_start_db:
+            logger.warning("speech-end-db (%s) is above speech-start-db (%s); using %s for both",
+                           self.speech_end_db, self.speech_start_db, self.speech_start_db)
+            self.speech_end_db = self.speech_start_db
+
+        self.speech_min_level = int(data.get(SPEECH_MIN_LEVEL) or DEFAULT_SPEECH_MIN_LEVEL)
+        self.noise_adapt_ms = int(data.get(NOISE_ADAPT_MS) or DEFAULT_NOISE_ADAPT_MS)
+        self.max_record_ms = int(data.get(MAX_RECORD_MS) or DEFAULT_MAX_RECORD_MS)
+
         self.text_lang = data.get(TEXT_LANGUAGE) or "en"
         self.text_accent = data.get(TEXT_ACCENT) or "com"
 
@@ -78,11 +241,63 @@ class Audio:
         self.volume = int(self.volume)
 
         self.audio_device = data.get(AUDIO_DEVICE)
+        self.output_device = data.get(AUDIO_OUTPUT_DEVICE)
 
         self.text_msg_line_ending = data.get(TEXT_MESSAGE_LINE_ENDING)
+        self.text_msg_max_length = int(
+            data.get(TEXT_MESSAGE_MAX_LENGTH) or DEFAULT_TEXT_MESSAGE_MAX_LENGTH
+        )
+        self.text_msg_emoji = data.get(TEXT_MESSAGE_EMOJI) or EMOJI_NAME
+        if self.text_msg_emoji not in (EMOJI_NAME, EMOJI_REMOVE):
+            logger.warning("Unknown text-message-emoji '%s'. Using '%s'.", self.text_msg_emoji,
+                           EMOJI_NAME)
+            self.text_msg_emoji = EMOJI_NAME
+
+        self.encoding = Encoding(data.get(AUDIO_ENCODING))
 
 
 # pylint: disable=too-few-public-methods
+class Encoding:
+    """
+    How outbound voice notes are encoded. The defaults match what Telegram's own clients send:
+    mono Opus at a speech-oriented VBR bitrate. Recordings are downmixed and resampled to this
+    format before they are handed to ffmpeg.
+    """
+
+    def __init__(self, data: dict = None):
+        if data is None:
+            data = {}
+
+        self.codec = data.get(ENCODING_CODEC) or CODEC_OPUS
+
+        self.sample_rate = int(data.get(ENCODING_SAMPLE_RATE) or DEFAULT_ENCODING_SAMPLE_RATE)
+        if self.codec == CODEC_OPUS and self.sample_rate not in OPUS_SAMPLE_RATES:
+            logger.warning("Opus does not support a sample-rate of %d. Using %d.",
+                           self.sample_rate, DEFAULT_ENCODING_SAMPLE_RATE)
+            self.sample_rate = DEFAULT_ENCODING_SAMPLE_RATE
+
+        self.channels = min(max(int(data.get(ENCODING_CHANNELS) or 1), 1), 2)
+        self.bitrate = str(data.get(ENCODING_BITRATE) or DEFAULT_ENCODING_BITRATE)
+        vbr = data.get(ENCODING_VBR)
+        if isinstance(vbr, bool):
+            vbr = "on" if vbr else "off"
+        self.vbr = vbr or DEFAULT_ENCODING_VBR
+        self.application = data.get(ENCODING_APPLICATION) or DEFAULT_ENCODING_APPLICATION
+
+    def ffmpeg_options(self) -> List[str]:
+        """Output options for ffmpeg"""
+        options = [
+            "-y", "-c:a", self.codec, "-b:a", self.bitrate,
+            "-ac", str(self.channels), "-ar", str(self.sample_rate),
+        ]
+        if self.codec == CODEC_OPUS:
+            options += ["-vbr", str(self.vbr), "-application", self.application]
+
+        return options + ["-f", "ogg"]
+
+
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-instance-attributes
 class Telegram:
     """Contain configuration options for Telegram client"""
 
@@ -94,93 +309,643 @@ class Telegram:
         self.api_hash = data.get(API_HASH)
         self.api_id = data.get(API_ID)
 
+        self.session_storage = data.get(TELEGRAM_SESSION_STORAGE) or SESSION_STORAGE_STRING
+        if self.session_storage not in (SESSION_STORAGE_STRING, SESSION_STORAGE_FILE):
+            logger.warning("Unknown session-storage '%s'. Using '%s'.", self.session_storage,
+                           SESSION_STORAGE_STRING)
+            self.session_storage = SESSION_STORAGE_STRING
+
+        # With file storage, Pyrogram keeps the auth key, peer cache and update state here,
+        # so restarts don't begin from nothing.
+        self.session_dir = session_dir
+        self.session_db_name = TELEGRAM_SESSION_DB
+        self.session_db_file = os.path.join(session_dir, f"{TELEGRAM_SESSION_DB}.session")
+
+        self.session = None
         self.session_file = os.path.join(session_dir, TELEGRAM_SESSION_FILE)
-        if not os.path.exists(self.session_file):
+        if os.path.exists(self.session_file):
+            with open(self.session_file, encoding="utf-8") as fhandle:
+                self.session = str(fhandle.read()).strip()
+
+        elif not self.uses_file_storage or not os.path.exists(self.session_db_file):
             print(
                 f"Telegram session not found at: {self.session_file}\n"
                 "You may need to run `intercompy-session-setup` again."
             )
 
-        else:
-            with open(self.session_file, encoding="utf-8") as fhandle:
-                self.session = str(fhandle.read()).strip()
-
         self.chat = data.get(CHAT)
 
+    @property
+    def uses_file_storage(self) -> bool:
+        """Whether the Telegram session is kept in a file-backed store"""
+        return self.session_storage == SESSION_STORAGE_FILE
+
+
+class RolodexEntry(NamedTuple):
+    """A single, immutable rolodex record"""
+
+    name: str
+    alias: str
+    pin: Optional[int]
+    volume: int
+    target: Union[str, int, None]
+    user_id: Optional[int]
+    username: Optional[str]
+    targets: Tuple[Union[str, int], ...]
+    modality: str = MODALITY_BOTH
+    is_intercom: bool = False
+
+    def __repr__(self):
+        return f"RolodexEntry({self.name!r}, pin={self.pin}, target={self.target!r})"
+
+    @property
+    def wants_voice(self) -> bool:
+        """Whether messages to this entry should include the voice recording"""
+        return self.modality in (MODALITY_VOICE, MODALITY_BOTH)
+
+    @property
+    def wants_text(self) -> bool:
+        """Whether messages to this entry should include a transcription"""
+        return self.modality in (MODALITY_TEXT, MODALITY_BOTH)
+
 
-# pylint: disable=too-few-public-methods
 class Rolodex:
-    """Contain configuration related to intercom chat members"""
+    """
+    Contain configuration related to intercom chat members. Entries are compiled once, when
+    the configuration is loaded, into immutable records indexed by GPIO pin, display name,
+    Telegram user id and Telegram username.
+    """
 
     def __init__(self, data: dict):
         if data is None:
             logger.debug("rolodex data is None. Using empty dict.")
             data = {}
 
-        self.data = data
+        by_name = {}
+        for name, entry in data.items():
+            by_name[name] = _compile_entry(name, entry or {})
+
+        by_pin = {}
+        by_user_id = {}
+        by_username = {}
+        by_target = {}
+        for entry in by_name.values():
+            entry = _resolve_entry_targets(entry, by_name)
+            by_name[entry.name] = entry
+
+            if entry.pin is not None:
+                if entry.pin in by_pin:
+                    logger.warning("Rolodex entries '%s' and '%s' share pin %d. Using '%s'.",
+                                   by_pin[entry.pin].name, entry.name, entry.pin,
+                                   by_pin[entry.pin].name)
+                else:
+                    by_pin[entry.pin] = entry
+
+            if entry.user_id is not None:
+                by_user_id.setdefault(entry.user_id, entry)
+            if entry.username is not None:
+                by_username.setdefault(entry.username, entry)
+            if entry.target is not None:
+                by_target.setdefault(entry.target, entry)
+
+        self._by_name = MappingProxyType(by_name)
+        self._by_pin = MappingProxyType(by_pin)
+        self._by_user_id = MappingProxyType(by_user_id)
+        self._by_username = MappingProxyType(by_username)
+        self._by_target = MappingProxyType(by_target)
+        self._pins = tuple(by_pin.keys())
+
+        logger.debug("Compiled rolodex: %s", list(by_name.values()))
+
+    def __setattr__(self, attr, value):
+        if hasattr(self, "_pins"):
+            raise AttributeError(f"Rolodex is immutable; cannot set '{attr}'")
+
+        object.__setattr__(self, attr, value)
+
+    def entries(self) -> Tuple[RolodexEntry, ...]:
+        """Return all rolodex entries"""
+        return tuple(self._by_name.values())
+
+    def get_entry(self, name: str) -> Optional[RolodexEntry]:
+        """Return the entry registered under the given display name"""
+        return self._by_name.get(name)
+
+    def get_pin_entry(self, pin: int) -> Optional[RolodexEntry]:
+        """Return the entry wired to the given GPIO pin"""
+        return self._by_pin.get(pin)
+
+    def find_sender(
+            self, user_id: Optional[int] = None, username: Optional[str] = None
+    ) -> Optional[RolodexEntry]:
+        """
+        Return the entry for a Telegram user, matched by user id first, then by username.
+        Display names are not used, since users can change them at will.
+        """
+        entry = None
+        if user_id is not None:
+            entry = self._by_user_id.get(user_id)
+        if entry is None and username:
+            entry = self._by_username.get(username.lstrip("@").lower())
+
+        return entry
+
+    def find_target(self, target: Union[str, int]) -> Optional[RolodexEntry]:
+        """Return the entry whose Telegram id / username is the given (resolved) target"""
+        return self._by_target.get(target)
 
     def get_alias(self, name: str) -> str:
         """Return the registered alias for the name, or else the name itself"""
-        if name in self.data:
-            return self.data[name]["alias"] or name
+        entry = self._by_name.get(name)
+        if entry is not None:
+            return entry.alias
 
         return name
 
-    def get_volume(self, name: str) -> str:
+    def get_volume(self, name: str) -> int:
         """Return the registered volume for the name, or else 100"""
-        if name in self.data:
-            return self.data[name]["volume"] or 100
+        entry = self._by_name.get(name)
+        if entry is not None:
+            return entry.volume
 
-        return name
+        return DEFAULT_VOLUME
 
-    def get_pin_alias(self, pin: int) -> str:
+    def get_pin_alias(self, pin: int) -> Optional[str]:
         """Return the registered alias for the pin, or else the name itself"""
-        for name, entry in self.data.items():
-            if int(entry["pin"]) == pin:
-                return entry["alias"] or name
+        entry = self._by_pin.get(pin)
+        if entry is not None:
+            return entry.alias
 
         return None
 
-    def get_pins(self) -> List[int]:
-        """Return the list of GPIO pins to watch"""
-        logger.debug("Extracting pins from: %s", self.data)
-        return [int(e["pin"]) for e in self.data.values()]
+    def get_pins(self) -> Tuple[int, ...]:
+        """Return the GPIO pins to watch"""
+        return self._pins
 
-    def get_pin_target(self, pin: int) -> Optional[str]:
+    def get_pin_target(self, pin: int) -> Optional[Union[str, int]]:
         """Return the target for the specified GPIO pin"""
-        for entry in self.data.values():
-            if int(entry["pin"]) == pin:
-                return entry["id"]
+        targets = self.get_pin_targets(pin)
+        if targets:
+            return targets[0]
 
         return None
 
+    def get_pin_targets(self, pin: int) -> List[Union[str, int]]:
+        """
+        Return all targets for the specified GPIO pin. A rolodex entry may name a group of
+        targets using the 'targets' key. Each item in that list is either the name of another
+        rolodex entry (whose id is used), or a raw Telegram id / username.
+        """
+        entry = self._by_pin.get(pin)
+        if entry is None:
+            return []
+
+        return list(entry.targets)
+
+
+def _compile_entry(name: str, entry: dict) -> RolodexEntry:
+    """Normalize one raw rolodex entry from YAML into an immutable record"""
+    pin = entry.get(PIN)
+    target = entry.get(TELEGRAM_ID)
+
+    user_id = entry.get(USER_ID)
+    if user_id is None and isinstance(target, int):
+        user_id = target
+
+    username = entry.get(USERNAME)
+    if username is None and isinstance(target, str) and target.startswith("@"):
+        username = target
+
+    # Intercoms play voice notes themselves, so by default they aren't sent transcriptions.
+    is_intercom = bool(entry.get(IS_INTERCOM))
+    modality = entry.get(MODALITY) or (MODALITY_VOICE if is_intercom else MODALITY_BOTH)
+    if modality not in MODALITIES:
+        logger.warning("Rolodex entry '%s' has unknown modality '%s'. Using '%s'.", name,
+                       modality, MODALITY_BOTH)
+        modality = MODALITY_BOTH
+
+    return RolodexEntry(
+        name=name,
+        alias=entry.get(ALIAS) or name,
+        pin=None if pin is None else int(pin),
+        volume=int(entry.get(VOLUME_OVERRIDE) or DEFAULT_VOLUME),
+        target=target,
+        user_id=None if user_id is None else int(user_id),
+        username=None if username is None else str(username).lstrip("@").lower(),
+        targets=tuple(entry.get(TARGETS) or ()),
+        modality=modality,
+        is_intercom=is_intercom,
+    )
+
+
+def _resolve_entry_targets(entry: RolodexEntry, by_name: dict) -> RolodexEntry:
+    """
+    Translate group member names into Telegram ids, so button presses don't need to look
+    anything up. Raw ids / usernames pass through unchanged.
+    """
+    if entry.targets:
+        targets = []
+        for member in entry.targets:
+            other = by_name.get(member) if isinstance(member, str) else None
+            if other is not None and other.target is not None:
+                targets.append(other.target)
+            else:
+                targets.append(member)
+    elif entry.target is not None:
+        targets = [entry.target]
+    else:
+        targets = []
+
+    return RolodexEntry(
+        name=entry.name,
+        alias=entry.alias,
+        pin=entry.pin,
+        volume=entry.volume,
+        target=entry.target,
+        user_id=entry.user_id,
+        username=entry.username,
+        targets=tuple(targets),
+        modality=entry.modality,
+        is_intercom=entry.is_intercom,
+    )
+
+
+# Shared by every room, so all rooms can use the same cache of rendered prompts.
+SHARED_AUDIO_KEYS = (TEXT_LANGUAGE, TEXT_ACCENT, AUDIO_PROMPTS)
+
+
+# pylint: disable=too-few-public-methods
+class Room:
+    """
+    One room's microphone, speaker and buttons. Buttons belong to the room that lists their
+    rolodex entry, and messages from a sender play in every room that lists the sender.
+    A room without a rolodex list takes everything.
+    """
+
+    def __init__(self, name: str, audio: Audio, entry_names: Optional[Set[str]] = None):
+        self.name = name
+        self.audio = audio
+        self.entry_names = None if entry_names is None else frozenset(entry_names)
+
+    def has_entry(self, entry: Optional[RolodexEntry]) -> bool:
+        """Whether buttons / messages for this rolodex entry belong to this room"""
+        if self.entry_names is None:
+            return True
+
+        return entry is not None and entry.name in self.entry_names
+
+
+def _compile_rooms(data: dict, audio: Audio, audio_data: dict, rolodex: Rolodex) -> dict:
+    """
+    Build the rooms from the 'rooms' section. Each room's 'audio' settings are laid over the
+    top-level audio section. Without a 'rooms' section, the intercom is a single room.
+    """
+    if not data:
+        return {DEFAULT_ROOM: Room(DEFAULT_ROOM, audio)}
+
+    rooms = {}
+    for name, room in data.items():
+        room = room or {}
+
+        overrides = dict(room.get(ROOM_AUDIO) or {})
+        for key in SHARED_AUDIO_KEYS:
+            if overrides.pop(key, None) is not None:
+                logger.warning("Room '%s' cannot override audio '%s'; it is shared by all rooms.",
+                               name, key)
+
+        merged = dict(audio_data or {})
+        merged.update(overrides)
+
+        entry_names = room.get(ROOM_ROLODEX)
+        if entry_names is not None:
+            for entry_name in entry_names:
+                if rolodex.get_entry(entry_name) is None:
+                    logger.warning("Room '%s' lists unknown rolodex entry '%s'", name,
+                                   entry_name)
+
+        rooms[name] = Room(name, Audio(merged, audio.audio_dir), entry_names)
+
+    return rooms
+
+
+# pylint: disable=too-few-public-methods
+class Buttons:
+    """Contain configuration for GPIO button handling"""
+
+    def __init__(self, data: dict = None):
+        if data is None:
+            data = {}
+
+        self.backend = data.get(BUTTONS_BACKEND) or BUTTONS_BACKEND_RPI
+
+        debounce = data.get(BUTTONS_DEBOUNCE)
+        self.debounce_ms = DEFAULT_DEBOUNCE_MS if debounce is None else int(debounce)
+
+        self.busy_policy = data.get(BUTTONS_BUSY_POLICY) or BUSY_POLICY_QUEUE
+        if self.busy_policy not in (BUSY_POLICY_QUEUE, BUSY_POLICY_REJECT):
+            logger.warning("Unknown button busy-policy '%s'. Using '%s'.", self.busy_policy,
+                           BUSY_POLICY_QUEUE)
+            self.busy_policy = BUSY_POLICY_QUEUE
+
+        queue_size = data.get(BUTTONS_QUEUE_SIZE)
+        self.queue_size = DEFAULT_BUTTON_QUEUE_SIZE if queue_size is None else int(queue_size)
+
+        # Holding a button this long replays the room's last message instead of recording.
+        # Off (0) by default, since presses have to wait this long before recording starts.
+        self.long_press_ms = int(data.get(BUTTONS_LONG_PRESS) or 0)
+
 
 # pylint: disable=too-few-public-methods
+class Workers:
+    """
+    Sizes of the worker pools used for blocking work. On a 4-core Pi, the encode pool is kept
+    to one less than the core count, so capture and the event loop always have a core.
+    """
+
+    def __init__(self, data: dict = None):
+        if data is None:
+            data = {}
+
+        self.network = int(data.get(POOL_NETWORK) or DEFAULT_NETWORK_WORKERS)
+        self.encode = int(data.get(POOL_ENCODE) or max((os.cpu_count() or 1) - 1, 1))
+        self.io = int(data.get(POOL_IO) or DEFAULT_IO_WORKERS)  # pylint: disable=invalid-name
+
+
+# pylint: disable=too-few-public-methods
+class SelfTest:
+    """
+    Latency budgets for `intercompy-selftest-audio`, in milliseconds, keyed by measurement
+    name (for example 'device-open' or 'tts.gtts'). Measurements without a budget are only
+    reported.
+    """
+
+    def __init__(self, data: dict = None, state_dir: str = None):
+        if data is None:
+            data = {}
+
+        self.budgets = {
+            str(name): float(limit) for name, limit in (data.get(SELFTEST_BUDGETS) or {}).items()
+        }
+        self.output = data.get(SELFTEST_OUTPUT) or (
+            os.path.join(state_dir, "selftest-audio.json") if state_dir else None
+        )
+
+
+# pylint: disable=too-few-public-methods
+class Spool:
+    """
+    Where media files that can't be kept in memory are written (VLC only plays from a path).
+    The default is a tmpfs, to spare the SD card; files are removed as soon as they're played.
+    """
+
+    def __init__(self, data: dict = None):
+        if data is None:
+            data = {}
+
+        self.spool_dir = data.get(SPOOL_DIR) or DEFAULT_SPOOL_DIR
+        self.max_bytes = int(data.get(SPOOL_MAX_BYTES) or DEFAULT_SPOOL_MAX_BYTES)
+
+
+# pylint: disable=too-few-public-methods
+class Replay:
+    """
+    Keep the last few inbound messages (voice notes, and the synthesized speech for texts) so
+    they can be played again. Kept next to the spool by default; 'max-messages: 0' turns it off.
+    """
+
+    def __init__(self, data: dict = None, spool: Spool = None):
+        if data is None:
+            data = {}
+
+        spool_dir = (spool or Spool()).spool_dir
+        self.replay_dir = data.get(REPLAY_DIR) or os.path.join(spool_dir, "replay")
+
+        max_messages = data.get(REPLAY_MAX_MESSAGES)
+        self.max_messages = (
+            DEFAULT_REPLAY_MAX_MESSAGES if max_messages is None else int(max_messages)
+        )
+        self.max_bytes = int(data.get(REPLAY_MAX_BYTES) or DEFAULT_REPLAY_MAX_BYTES)
+
+    @property
+    def enabled(self) -> bool:
+        """Whether any messages are kept for replay"""
+        return self.max_messages > 0
+
+
+# pylint: disable=too-few-public-methods
+# pylint: disable=too-many-instance-attributes
 class Tracing:
     """Tracing configuration"""
 
-    def __init__(self, data: dict = None):
+    def __init__(self, data: dict = None, state_dir: str = APP_STATE_DIR):
         if data is None:
             logger.debug("tracing config is None. Using empty dict.")
             data = {}
 
         self.intercom_name = data.get(TRACING_INTERCOM_NAME)
 
+        self.exporter = data.get(TRACING_EXPORTER) or EXPORTER_OTLP
+        if self.exporter not in EXPORTERS:
+            logger.warning("Unknown tracing exporter '%s'. Using '%s'.", self.exporter,
+                           EXPORTER_NONE)
+            self.exporter = EXPORTER_NONE
+
+        self.endpoint = data.get(TRACING_ENDPOINT) or DEFAULT_OTLP_ENDPOINT
+        self.file = os.path.join(state_dir, data.get(TRACING_FILE) or DEFAULT_TRACES_FILE)
+        self.file_max_bytes = int(
+            data.get(TRACING_FILE_MAX_BYTES) or DEFAULT_TELEMETRY_FILE_MAX_BYTES
+        )
+        self.file_backups = int(data.get(TRACING_FILE_BACKUPS) or DEFAULT_TELEMETRY_FILE_BACKUPS)
+
+        self.max_queue_size = int(data.get(TRACING_MAX_QUEUE_SIZE) or DEFAULT_MAX_QUEUE_SIZE)
+        self.max_export_batch_size = min(
+            int(data.get(TRACING_MAX_EXPORT_BATCH_SIZE) or DEFAULT_MAX_EXPORT_BATCH_SIZE),
+            self.max_queue_size,
+        )
+        self.export_delay_ms = int(data.get(TRACING_EXPORT_DELAY) or DEFAULT_EXPORT_DELAY_MS)
+        self.export_timeout_ms = int(
+            data.get(TRACING_EXPORT_TIMEOUT) or DEFAULT_EXPORT_TIMEOUT_MS
+        )
+
+        self.metrics_file = os.path.join(
+            state_dir, data.get(TRACING_METRICS_FILE) or DEFAULT_METRICS_FILE
+        )
+        self.metrics_interval_ms = int(
+            data.get(TRACING_METRICS_INTERVAL) or DEFAULT_METRICS_INTERVAL_MS
+        )
+        self.metrics_samples = int(data.get(TRACING_METRICS_SAMPLES) or DEFAULT_METRICS_SAMPLES)
+
+        enabled = data.get(TRACING_ENABLED)
+        self.enabled = (True if enabled is None else bool(enabled)) \
+            and self.exporter != EXPORTER_NONE
+
+        sample_rate = data.get(TRACING_SAMPLE_RATE)
+        self.sample_rate = 1.0 if sample_rate is None else min(max(float(sample_rate), 0.0), 1.0)
+
+    def otlp_endpoint(self, signal: str) -> str:
+        """
+        The OTLP/HTTP URL for one signal ('traces' or 'metrics'). 'endpoint' is the collector's
+        base URL; a signal path already on the end of it is replaced.
+        """
+        base = self.endpoint.rstrip("/")
+        for known in OTLP_SIGNALS:
+            if base.endswith(f"/v1/{known}"):
+                base = base[:-len(f"/v1/{known}")]
+
+        return f"{base}/v1/{signal}"
+
+
+SECTION_ATTRIBUTES = {
+    TELEGRAM_SECTION: "telegram",
+    AUDIO_SECTION: "audio",
+    ROLODEX: "rolodex",
+    BUTTONS_SECTION: "buttons",
+    ROOMS_SECTION: "rooms",
+    WORKERS_SECTION: "workers",
+    SPOOL_SECTION: "spool",
+    REPLAY_SECTION: "replay",
+    SELFTEST_SECTION: "selftest",
+    TRACING_SECTION: "tracing",
+}
+
+# Sections that are only read at startup; changing them requires a restart.
+RESTART_SECTIONS = (TELEGRAM_SECTION, SPOOL_SECTION, REPLAY_SECTION, TRACING_SECTION)
+
+DEFAULT_WATCH_INTERVAL = 5.0
+
 
-# pylint: disable=too-few-public-methods
 class Config:
     """Contain the configuration parameters for intercompy"""
 
-    def __init__(self, data: dict, app_state_dir: str):
+    def __init__(self, data: dict, app_state_dir: str, path: str = None):
         if data is None:
             data = {}
 
+        self.data = data
+        self.app_state_dir = app_state_dir
+        self.path = path
+        self._listeners: List[Callable] = []
+
         self.telegram = Telegram(data.get(TELEGRAM_SECTION), app_state_dir)
         self.audio = Audio(
             data.get(AUDIO_SECTION), os.path.join(app_state_dir, "audio")
         )
         self.rolodex = Rolodex(data.get(ROLODEX))
-        self.tracing = Tracing(data.get(TRACING_SECTION))
+        self.rooms = _compile_rooms(
+            data.get(ROOMS_SECTION), self.audio, data.get(AUDIO_SECTION), self.rolodex
+        )
+        self.buttons = Buttons(data.get(BUTTONS_SECTION))
+        self.workers = Workers(data.get(WORKERS_SECTION))
+        self.spool = Spool(data.get(SPOOL_SECTION))
+        self.replay = Replay(data.get(REPLAY_SECTION), self.spool)
+        self.selftest = SelfTest(data.get(SELFTEST_SECTION), app_state_dir)
+        self.tracing = Tracing(data.get(TRACING_SECTION), app_state_dir)
+
+    def get_room(self, name: Optional[str] = None) -> Optional[Room]:
+        """Return the named room, or the first configured room if no name is given"""
+        if name is None:
+            return next(iter(self.rooms.values()))
+
+        return self.rooms.get(name)
+
+    def get_pin_room(self, pin: int) -> Room:
+        """Return the room a button is in. Buttons no room claims belong to the first room."""
+        entry = self.rolodex.get_pin_entry(pin)
+        for room in self.rooms.values():
+            if room.has_entry(entry):
+                return room
+
+        return self.get_room()
+
+    def get_sender_rooms(self, entry: Optional[RolodexEntry]) -> List[Room]:
+        """Return the rooms a sender's messages play in. Senders no room claims play in all."""
+        rooms = [room for room in self.rooms.values() if room.has_entry(entry)]
+        return rooms or list(self.rooms.values())
+
+    def add_listener(self, listener: Callable[["Config", "Config", Set[str]], Awaitable]):
+        """
+        Register a coroutine function to be called after a reload changes any section. It
+        receives this config, a snapshot of the previous one, and the changed section names.
+        """
+        self._listeners.append(listener)
+
+    def update(self, data: dict) -> Tuple["Config", Set[str]]:
+        """
+        Replace the sections that differ from 'data'. Everything is parsed before anything is
+        swapped, so a broken file leaves the running configuration untouched. Returns a
+        snapshot of the previous configuration and the names of the changed sections.
+        """
+        if data is None:
+            data = {}
+
+        changed = {
+            section for section in SECTION_ATTRIBUTES
+            if data.get(section) != self.data.get(section)
+        }
+        if not changed:
+            return copy(self), changed
+
+        fresh = Config(data, self.app_state_dir, self.path)
+        previous = copy(self)
+
+        for section in changed:
+            attr = SECTION_ATTRIBUTES[section]
+            setattr(self, attr, getattr(fresh, attr))
+
+        # Rooms are built from the audio and rolodex sections too.
+        self.rooms = fresh.rooms
+        self.data = data
+
+        return previous, changed
+
+    async def reload(self) -> Set[str]:
+        """Re-read the config file, apply any changes, and notify listeners"""
+        with open(self.path, encoding="utf-8") as _f:
+            data = YAML().load(_f)
+
+        previous, changed = self.update(data)
+        if not changed:
+            return changed
+
+        logger.info("Configuration sections changed: %s", ", ".join(sorted(changed)))
+        for section in changed.intersection(RESTART_SECTIONS):
+            logger.warning("Changes to the '%s' section take effect after a restart.", section)
+
+        for listener in self._listeners:
+            try:
+                await listener(self, previous, changed)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error("Failed to apply configuration change: %s", error)
+
+        return changed
+
+
+async def watch_config(cfg: Config, interval: float = DEFAULT_WATCH_INTERVAL):
+    """Poll the config file for changes, and apply them to the running configuration"""
+    if cfg.path is None:
+        return
+
+    def stamp():
+        try:
+            stat = os.stat(cfg.path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    print(f"Watching {cfg.path} for configuration changes")
+    last = stamp()
+    while True:
+        await sleep(interval)
+
+        current = stamp()
+        if current is None or current == last:
+            continue
+
+        last = current
+        try:
+            await cfg.reload()
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Ignoring unreadable configuration at %s: %s", cfg.path, error)
 
 
 def load_config(config_file: str = None) -> Config:
@@ -190,6 +955,9 @@ def load_config(config_file: str = None) -> Config:
     following order of precedence:
         $HOME/.config/intercompy/config.yaml
         /etc/intercompy/config.yaml
+
+    The returned config remembers its path; run watch_config() on it to apply later edits
+    to the file without restarting.
     """
     config_path = config_file or HOME_CONFIG_FILE
     if os.path.exists(config_path) is not True:
@@ -208,4 +976,4 @@ def load_config(config_file: str = None) -> Config:
     if not os.path.isdir(APP_STATE_DIR):
         os.makedirs(APP_STATE_DIR)
 
-    return Config(data, APP_STATE_DIR)
+    return Config(data, APP_STATE_DIR, config_path)
@@ -1,9 +1,9 @@
 """Handle Telegram conversations started by others, or responses from others"""
 import logging
-import os
-from asyncio import sleep
-from tempfile import NamedTemporaryFile
-from typing import Union
+from asyncio import ensure_future, gather, sleep
+from functools import partial
+from time import monotonic
+from typing import BinaryIO, Callable, Collection, List, Optional, Tuple, Union
 
 import opentelemetry
 from pyrogram import Client
@@ -11,6 +11,9 @@ from pyrogram import filters
 from pyrogram.types import Message
 
 from intercompy.audio import (
+    Recording,
+    capture_voice,
+    encode_ogg,
     record_ogg,
     playback_ogg,
     play_impromptu_text,
@@ -20,8 +23,13 @@ from intercompy.audio import (
     SND_INTERCOM_ONLINE,
     SND_SNOOPING_AUDIO_START,
     SND_SENDING_MESSAGE,
+    SND_PROCESSING_RECORDING,
 )
-from intercompy.config import Config, Telegram
+from intercompy import metrics
+from intercompy.config import Config, Room, Telegram, DEFAULT_VOLUME
+from intercompy.replay import KIND_TEXT, KIND_VOICE, REPLAY, play_replay
+from intercompy.session import seed_file_storage, session_client, warm_peer_cache
+from intercompy.spool import spool_file
 from intercompy.text import setup_text_analysis, format_inbound_message_for_speech
 from intercompy.tracing import trace
 
@@ -32,23 +40,166 @@ logger = logging.getLogger(__name__)
 
 @trace
 async def record_and_send(
-        target: Union[str, int], app: Client, cfg: Config, stop_fn=None
+        target: Union[str, int, List[Union[str, int]]], app: Client, cfg: Config, stop_fn=None,
+        room: Optional[Room] = None
 ):
-    """Record and send a voice recording to the chat channel"""
-    await play_prompt_text(SND_RECORD_YOUR_MESSAGE, cfg.audio)
+    """
+    Record and send a voice recording to the chat channel. If a list of targets is given,
+    the recording is encoded, transcribed and uploaded only once; the remaining targets are
+    sent the resulting Telegram file_id concurrently.
+    """
+    recording = await record_message(cfg, stop_fn, room=room)
+    await send_recording(target, recording, app, cfg, room)
+
+
+@trace
+async def record_message(
+        cfg: Config, stop_fn=None, pressed_at: Optional[float] = None,
+        room: Optional[Room] = None
+) -> Recording:
+    """
+    Prompt the user, then capture their message from the room's microphone. The processing
+    and sending prompts play before this returns: once it does, the next queued press can
+    start recording in the room, and its recording mustn't pick them up.
+    """
+    audio = (room or cfg.get_room()).audio
+    await play_prompt_text(SND_RECORD_YOUR_MESSAGE, audio)
+
+    if pressed_at is not None:
+        metrics.record_since(metrics.OUTBOUND_PRESS_TO_CAPTURE, pressed_at)
 
     print("Recording voice.")
-    oggfile = await record_ogg(cfg.audio, stop_fn)
+    recording = await capture_voice(audio, stop_fn)
+
+    await play_prompt_text(SND_PROCESSING_RECORDING, audio)
+    await play_prompt_text(SND_SENDING_MESSAGE, audio)
+    return recording
+
+
+@trace
+async def send_recording(
+        target: Union[str, int, List[Union[str, int]]], recording: Recording, app: Client,
+        cfg: Config, room: Optional[Room] = None
+):
+    """
+    Encode, transcribe and send a captured recording to one or more targets. Each target's
+    rolodex modality decides what it gets: the voice note, the transcription, or both (as a
+    caption). Transcription is skipped when no target wants text, as between intercoms.
+    """
+    targets = target if isinstance(target, list) else [target]
+    audio = (room or cfg.get_room()).audio
+
+    entries = [cfg.rolodex.find_target(t) for t in targets]
+    voice_targets = [t for t, e in zip(targets, entries) if e is None or e.wants_voice]
+    text_targets = [t for t, e in zip(targets, entries) if e is not None and not e.wants_voice]
+    captioned = {t for t, e in zip(targets, entries) if e is None or e.wants_text}
+    opentelemetry.trace.get_current_span().set_attributes({
+        "outbound.voice-targets": len(voice_targets),
+        "outbound.text-only-targets": len(text_targets),
+        "outbound.transcribe": bool(captioned),
+    })
+
+    oggfile = await encode_ogg(recording, audio)
+    metrics.record_since(metrics.OUTBOUND_CAPTURE_TO_ENCODED, recording.captured_at)
+    encoded_at = monotonic()
 
     print("Sending voice")
-    await play_prompt_text(SND_SENDING_MESSAGE, cfg.audio)
 
-    txt = await speech_to_text(oggfile)
-    with open(oggfile.name, "rb") as _f:
-        logging.debug("Sending voice message to: %s", target)
-        await app.send_voice(target, _f, caption=txt)
+    txt = ""
+    if captioned:
+        with metrics.Timer(metrics.OUTBOUND_TRANSCRIPTION):
+            txt = await speech_to_text(oggfile)
+    else:
+        logger.debug("No target wants a transcription; skipping speech-to-text")
+
+    await gather(
+        send_voice_to_targets(voice_targets, oggfile, app, txt, captioned),
+        send_text_to_targets(text_targets, txt, app),
+    )
+    metrics.record_since(metrics.OUTBOUND_ENCODED_TO_SENT, encoded_at)
+
+
+@trace
+async def send_voice_to_targets(
+        targets: List[Union[str, int]], voice: BinaryIO, app: Client, caption: str,
+        captioned: Optional[Collection[Union[str, int]]] = None
+):
+    """
+    Upload a voice note to the first target that accepts it, then reuse the uploaded file_id
+    to send it to the rest of the targets concurrently. The caption goes only to targets in
+    'captioned', or to all of them if that isn't given. Raises only if no target accepts
+    the upload.
+    """
+
+    def caption_for(target) -> str:
+        return caption if captioned is None or target in captioned else ""
+
+    opentelemetry.trace.get_current_span().set_attribute("telegram.target-count",
+                                                         len(targets))
+    if not targets:
+        logger.warning("No targets to send voice message to!")
+        return
+
+    sent, rest = await _upload_voice(targets, voice, app, caption_for)
+    if not rest:
+        return
+
+    file_id = sent.voice.file_id
+    logger.debug("Forwarding uploaded voice %s to: %s", file_id, rest)
+    results = await gather(
+        *[app.send_voice(other, file_id, caption=caption_for(other)) for other in rest],
+        return_exceptions=True,
+    )
+    for other, result in zip(rest, results):
+        if isinstance(result, Exception):
+            metrics.count(metrics.OUTBOUND_FAILURES)
+            logger.error("Failed to send voice message to %s: %s", other, result)
+        else:
+            metrics.count(metrics.OUTBOUND_MESSAGES)
+
+
+async def _upload_voice(
+        targets: List[Union[str, int]], voice: BinaryIO, app: Client,
+        caption_for: Callable[[Union[str, int]], str]
+) -> Tuple[Message, List[Union[str, int]]]:
+    """
+    Upload the voice note to each target in turn until one accepts it. Returns the sent
+    message and the targets after that one.
+    """
+    for idx, target in enumerate(targets):
+        voice.seek(0)
+        logger.debug("Uploading voice message to: %s", target)
+        try:
+            sent = await app.send_voice(target, voice, caption=caption_for(target))
+        except Exception as error:  # pylint: disable=broad-except
+            metrics.count(metrics.OUTBOUND_FAILURES)
+            logger.error("Failed to send voice message to %s: %s", target, error)
+            if idx == len(targets) - 1:
+                raise
+            continue
+
+        metrics.count(metrics.OUTBOUND_MESSAGES)
+        return sent, targets[idx + 1:]
+
+    raise ValueError("No targets to upload the voice message to")
+
 
-    os.remove(oggfile.name)
+@trace
+async def send_text_to_targets(targets: List[Union[str, int]], text: str, app: Client):
+    """Send a transcription, without the recording, to text-only targets concurrently"""
+    if not targets:
+        return
+
+    results = await gather(
+        *[app.send_message(target, text or "*no speech detected*") for target in targets],
+        return_exceptions=True,
+    )
+    for target, result in zip(targets, results):
+        if isinstance(result, Exception):
+            metrics.count(metrics.OUTBOUND_FAILURES)
+            logger.error("Failed to send text message to %s: %s", target, result)
+        else:
+            metrics.count(metrics.OUTBOUND_MESSAGES)
 
 
 async def goodbye(app: Client, cfg: Telegram, sig, frame):
@@ -63,50 +214,98 @@ def setup_telegram(cfg: Config) -> Client:
     # , cfg.telegram.api_id, cfg.telegram.api_hash)
     logger.debug("Setting up Telegram client...")
     setup_text_analysis()
-    return Client(cfg.telegram.account_name, session_string=cfg.telegram.session)
+    return session_client(cfg.telegram)
 
 
-# pylint: disable=too-many-statements
 def format_sender_name(message: Message, cfg: Config) -> str:
     """
-    Lookup the configured rolodex alias for a sender's first and last name, or default to that
-    given first and last name. This will format the name for text-to-speech.
+    Lookup the configured rolodex alias for a sender (matched by Telegram user id or
+    username), or default to their given first and last name. This will format the name for
+    text-to-speech.
     """
-    name = f"{message.from_user.first_name} {message.from_user.last_name}"
-    return cfg.rolodex.get_alias(name)
+    user = message.from_user
+    entry = cfg.rolodex.find_sender(user.id, user.username)
+    if entry is not None:
+        return entry.alias
+
+    return " ".join(part for part in (user.first_name, user.last_name) if part)
 
 
-# pylint: disable=too-many-statements
 def get_sender_volume(message: Message, cfg: Config) -> int:
     """
-    Lookup the configured rolodex volume for a sender's first and last name, or default to 100.
+    Lookup the configured rolodex volume for a sender (matched by Telegram user id or
+    username), or default to 100.
     """
-    name = f"{message.from_user.first_name} {message.from_user.last_name}"
-    return cfg.rolodex.get_volume(name)
+    user = message.from_user
+    entry = cfg.rolodex.find_sender(user.id, user.username)
+    if entry is not None:
+        return entry.volume
 
+    return DEFAULT_VOLUME
 
-async def start_telegram(app: Client, cfg: Config):
-    """Setup / start the Telegram bot"""
+
+def get_sender_rooms(message: Message, cfg: Config) -> List[Room]:
+    """
+    Lookup the rooms that play messages from a sender (matched by Telegram user id or
+    username). Senders no room claims play in every room.
+    """
+    user = message.from_user
+    entry = cfg.rolodex.find_sender(user.id, user.username)
+    rooms = cfg.get_sender_rooms(entry)
+    opentelemetry.trace.get_current_span().set_attribute(
+        "rooms", ",".join(room.name for room in rooms)
+    )
+    return rooms
+
+
+def _add_room_commands(app: Client, cfg: Config):
+    """Register the commands that use the rooms: /audiograb and /replay"""
 
     @app.on_message(
         filters=filters.command(commands="audiograb", prefixes=COMMAND_PREFIXES)
     )
     @trace
     async def audiograb(_client: Client, message: Message):
-        """Record and send voice over Telegram"""
-        await play_prompt_text(SND_SNOOPING_AUDIO_START, cfg.audio)
+        """Record and send voice over Telegram, from the named room or else the first one"""
+        name = message.command[1] if len(message.command or []) > 1 else None
+        room = cfg.get_room(name)
+        if room is None:
+            await message.reply_text(f"Unknown room: {name}. Rooms: {', '.join(cfg.rooms)}")
+            return
+
+        await play_prompt_text(SND_SNOOPING_AUDIO_START, room.audio)
         await sleep(3)
         # print("Grabbing current audio sample...")
-        oggfile = await record_ogg(cfg.audio)
+        oggfile = await record_ogg(room.audio)
 
-        await play_prompt_text(SND_SENDING_MESSAGE, cfg.audio)
-        with open(oggfile.name, "rb") as _f:
-            logger.debug("Sending voice response to: %s", message.from_user.username)
-            await message.reply_voice(voice=_f)
+        await play_prompt_text(SND_SENDING_MESSAGE, room.audio)
+        logger.debug("Sending voice response to: %s", message.from_user.username)
+        await message.reply_voice(voice=oggfile)
 
         txt = await speech_to_text(oggfile)
         await message.reply_text(f"Text translation: {txt}")
-        os.remove(oggfile.name)
+
+    @app.on_message(filters=filters.command(commands="replay", prefixes=COMMAND_PREFIXES))
+    @trace
+    async def replay(_client: Client, message: Message):
+        """Play the last few received messages again, from the replay cache"""
+        arg = message.command[1] if len(message.command or []) > 1 else "1"
+        if not arg.isdigit() or int(arg) < 1:
+            await message.reply_text(f"Not a number of messages: {arg}")
+            return
+
+        entries = REPLAY.recent(int(arg))
+        opentelemetry.trace.get_current_span().set_attribute("replay.count", len(entries))
+        if not entries:
+            await message.reply_text("There are no messages to replay.")
+            return
+
+        await message.reply_text(f"Replaying {len(entries)} message(s)")
+        await play_replay(entries, cfg)
+
+
+def _add_info_commands(app: Client):
+    """Register the commands that report on the intercom and its chats"""
 
     @app.on_message(
         filters=filters.command(commands="chatinfo", prefixes=COMMAND_PREFIXES)
@@ -148,6 +347,17 @@ async def start_telegram(app: Client, cfg: Config):
         )
         await message.reply_text(msg)
 
+    @app.on_message(filters=filters.command(commands="stats", prefixes=COMMAND_PREFIXES))
+    @trace
+    async def stats(_client: Client, message: Message):
+        """Send recent latency percentiles and message counts to Telegram"""
+        logger.debug(
+            "sending stats message to: %s in chat: %s",
+            message.from_user.username,
+            message.chat.id,
+        )
+        await message.reply_text(metrics.format_stats())
+
     @app.on_message(filters=filters.command(commands="help", prefixes=COMMAND_PREFIXES))
     @trace
     async def show_help(_client: Client, message: Message):
@@ -159,65 +369,104 @@ async def start_telegram(app: Client, cfg: Config):
         )
 
         msg = (
-            "/audiograb  - Record audio on the device and send it as a voice recording"
+            "/audiograb [room] - Record audio on the device and send it as a voice recording"
             "\n/chatinfo - Display details about the current chat location"
             "\n/contacts - Display known contacts"
+            "\n/stats    - Display recent latency percentiles"
+            "\n/replay [count] - Play the last received message(s) again"
             "\n/help     - Show this help message"
         )
 
         await message.reply_text(msg)
 
+
+def _add_message_handlers(app: Client, cfg: Config):
+    """Register the handlers that play received voice and text messages"""
+
     @app.on_message(filters=filters.voice)
     @trace
     async def play_voice_message(_client: Client, message: Message):
         """Play a received voice message"""
+        metrics.begin_inbound()
         opentelemetry.trace.get_current_span().set_attribute("voice.present",
                                                              1 if message.voice is not None else 0)
 
         if message.voice is not None:
+            metrics.count(metrics.INBOUND_MESSAGES, attributes={"kind": "voice"})
+            rooms = get_sender_rooms(message, cfg)
+            outputs = [room.audio for room in rooms]
+            sender = format_sender_name(message, cfg)
+            cached = REPLAY.add(KIND_VOICE, sender, [room.name for room in rooms])
             await play_impromptu_text(
-                f"New voice message from: {format_sender_name(message, cfg)}", cfg.audio
+                f"New voice message from: {sender}", cfg.audio, outputs,
+                keep=partial(REPLAY.keep, cached)
             )
 
             fext = message.voice.mime_type.split("/")[-1]
 
-            with NamedTemporaryFile(
-                    "wb",
-                    prefix="intercom." + message.voice.file_unique_id + ".",
-                    suffix="." + fext,
-                    delete=False,
-            ) as temp:
-                await message.download(file_name=temp.name)
+            # VLC plays from a path, so the download goes to the (tmpfs) spool.
+            with spool_file(
+                    "intercom." + message.voice.file_unique_id + ".", "." + fext
+            ) as fname:
+                with metrics.Timer(metrics.INBOUND_DOWNLOAD):
+                    await message.download(file_name=fname)
 
-                await playback_ogg(
-                    temp.name, cfg.audio, get_sender_volume(message, cfg)
-                )
-
-                os.remove(temp.name)
+                volume = get_sender_volume(message, cfg)
+                fname = await REPLAY.keep(cached, fname, volume)
+                await gather(*[playback_ogg(fname, output, volume) for output in outputs])
 
     @app.on_message(filters=filters.text)
     @trace
     async def play_prompt_text_message(_client: Client, message: Message):
         """Play a received voice message"""
+        metrics.begin_inbound()
         opentelemetry.trace.get_current_span().set_attribute("text.present",
                                                              1 if message.text is not None else 0)
 
         if message.text is not None:
+            metrics.count(metrics.INBOUND_MESSAGES, attributes={"kind": "text"})
+
+            # Another intercom talks in voice notes; any text it sends duplicates one of them.
+            user = message.from_user
+            entry = cfg.rolodex.find_sender(user.id, user.username)
+            if entry is not None and entry.is_intercom and not entry.wants_text:
+                opentelemetry.trace.get_current_span().set_attribute("text.skipped", 1)
+                logger.debug("Not reading out text from intercom %s", entry.name)
+                return
+
             formatted_txt = await format_inbound_message_for_speech(message.text, cfg.audio)
+            rooms = get_sender_rooms(message, cfg)
+            sender = format_sender_name(message, cfg)
+            cached = REPLAY.add(KIND_TEXT, sender, [room.name for room in rooms])
             await play_impromptu_text(
-                f"Text from: {format_sender_name(message, cfg)}. "
-                f"Message reads: {formatted_txt}",
+                f"Text from: {sender}. Message reads: {formatted_txt}",
                 cfg.audio,
+                [room.audio for room in rooms],
+                keep=partial(REPLAY.keep, cached),
             )
 
+
+async def start_telegram(app: Client, cfg: Config):
+    """Setup / start the Telegram bot"""
+
+    # Pyrogram runs the first matching handler, so commands go ahead of the text handler.
+    _add_room_commands(app, cfg)
+    _add_info_commands(app)
+    _add_message_handlers(app, cfg)
+
     @trace
     async def do_startup():
         logger.debug("Starting Telegram client")
+        await seed_file_storage(cfg.telegram)
         await app.start()
         _me = await app.get_me()
+        warming = ensure_future(warm_peer_cache(app, cfg))
         logger.debug("Playing online sound")
-        await play_prompt_text(SND_INTERCOM_ONLINE, cfg.audio)
+        await gather(*[
+            play_prompt_text(SND_INTERCOM_ONLINE, room.audio) for room in cfg.rooms.values()
+        ])
         logger.debug("Sending hello to %s", cfg.telegram.chat)
         await app.send_message(cfg.telegram.chat, f"{_me.username} is online 🎉")
+        await warming
 
     await do_startup()
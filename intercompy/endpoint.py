@@ -0,0 +1,154 @@
+"""
+Decide when a spoken message starts and ends, relative to the room's background noise.
+
+The endpointer splits the microphone signal into short frames and tracks the ambient noise
+floor as a slow moving average of frame levels (RMS) outside of speech. Speech starts when a
+frame rises 'speech-start-db' above the floor, and only ends once frames have stayed below the
+lower 'speech-end-db' threshold for 'hangover-ms'. The gap between the two thresholds
+(hysteresis) keeps pauses between words from ending the message, while tracking the floor
+lets a noisy kitchen end a message as promptly as a quiet bedroom.
+"""
+import math
+from array import array
+from operator import mul
+from typing import Optional, Tuple
+
+from intercompy.config import Audio
+
+FRAME_MS = 20
+PAD_MS = 150
+
+# While speech is active, the floor still adapts, but this much slower, so a sustained rise
+# in background noise can't hold a message open forever.
+SPEECH_ADAPT_SLOWDOWN = 10
+
+
+def _db_ratio(decibels: float) -> float:
+    return 10 ** (decibels / 20.0)
+
+
+def frame_level(frame: array) -> float:
+    """RMS level of a frame of signed 16-bit samples"""
+    if not frame:
+        return 0.0
+
+    return math.sqrt(sum(map(mul, frame, frame)) / len(frame))
+
+
+# pylint: disable=too-many-instance-attributes
+class Endpointer:
+    """Feed it chunks of interleaved PCM; it reports when the message has ended"""
+
+    def __init__(self, cfg: Audio, rate: int, channels: int):
+        self.channels = channels
+        self.frame_size = max(int(rate * FRAME_MS / 1000), 1) * channels
+        self.samples_per_ms = rate * channels / 1000.0
+
+        self.start_ratio = _db_ratio(cfg.speech_start_db)
+        self.end_ratio = _db_ratio(cfg.speech_end_db)
+        self.min_level = float(cfg.speech_min_level)
+        self.hangover_ms = cfg.hangover_ms
+        self.max_samples = int(cfg.max_record_ms * self.samples_per_ms)
+        self.adapt = min(FRAME_MS / float(max(cfg.noise_adapt_ms, FRAME_MS)), 1.0)
+
+        self.noise_floor: Optional[float] = None
+        self.speaking = False
+        self.speech_start: Optional[int] = None
+        self.speech_end: Optional[int] = None
+        self.quiet_ms = 0.0
+        self.ended = False
+
+        self._position = 0
+        self._pending = array("h")
+
+    @property
+    def heard_speech(self) -> bool:
+        """Whether speech has started at any point"""
+        return self.speech_start is not None
+
+    def thresholds(self) -> Tuple[float, float]:
+        """The current (start, end) levels, derived from the noise floor"""
+        floor = self.noise_floor or 0.0
+        start = max(floor * self.start_ratio, self.min_level)
+        end = max(floor * self.end_ratio, self.min_level * self.end_ratio / self.start_ratio)
+        return start, end
+
+    def feed(self, samples: array) -> bool:
+        """Analyze the next chunk of samples. Returns True once the message has ended."""
+        self._pending.extend(samples)
+
+        size = self.frame_size
+        consumed = 0
+        while not self.ended and len(self._pending) - consumed >= size:
+            self._frame(self._pending[consumed:consumed + size])
+            consumed += size
+
+        del self._pending[:consumed]
+
+        if not self.ended and self._position >= self.max_samples:
+            if self.heard_speech:
+                self.speech_end = self._position
+            self.ended = True
+
+        return self.ended
+
+    def _frame(self, frame: array):
+        level = frame_level(frame)
+        if self.noise_floor is None:
+            self.noise_floor = level
+
+        start_level, end_level = self.thresholds()
+        position = self._position
+        self._position += len(frame)
+
+        if not self.speaking:
+            if level >= start_level:
+                self.speaking = True
+                self.quiet_ms = 0.0
+                if self.speech_start is None:
+                    self.speech_start = position
+                self.speech_end = self._position
+                return
+
+            self._track_floor(level, self.adapt)
+            return
+
+        if level >= end_level:
+            self.quiet_ms = 0.0
+            self.speech_end = self._position
+        else:
+            self.quiet_ms += FRAME_MS
+            if self.quiet_ms >= self.hangover_ms:
+                self.speaking = False
+                self.ended = True
+
+        self._track_floor(level, self.adapt / SPEECH_ADAPT_SLOWDOWN)
+
+    def _track_floor(self, level: float, rate: float):
+        # Follow drops in noise quickly, and rises slowly, so speech doesn't drag it up.
+        if level < self.noise_floor:
+            rate = min(rate * 4, 1.0)
+
+        self.noise_floor += (level - self.noise_floor) * rate
+
+    def span_attributes(self) -> dict:
+        """Describe how the recording ended, for tracing"""
+        return {
+            "wav-sound-detected": self.heard_speech,
+            "endpointer.noise-floor": round(self.noise_floor or 0.0, 1),
+            "endpointer.ended": self.ended,
+        }
+
+    def trim(self, samples: array) -> array:
+        """
+        Cut a recording down to the detected speech, keeping a short pad either side. The
+        cut points are whole frames, so interleaved channels stay aligned.
+        """
+        if self.speech_start is None:
+            return samples[0:0]
+
+        pad = int(PAD_MS * self.samples_per_ms)
+        pad -= pad % self.channels
+
+        end = self.speech_end if self.speech_end is not None else len(samples)
+        return samples[max(self.speech_start - pad, 0):min(end + pad, len(samples))]
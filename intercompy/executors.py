@@ -0,0 +1,104 @@
+"""
+Named thread pools for blocking work that would otherwise stall the event loop.
+
+Each pool is sized for the resource it waits on: 'network' for gTTS synthesis and speech
+recognition calls, 'encode' for CPU-heavy audio decoding / encoding, and 'io' for file work
+(writing synthesized speech, checking prompts, moving files into the replay cache). Microphone
+reads don't use a pool: each capture reads on a thread of its own. Submissions are
+instrumented with in-flight counts and queue wait times.
+"""
+import logging
+from asyncio import get_event_loop
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from time import monotonic
+from typing import Callable, Dict, Set
+
+from intercompy import metrics
+from intercompy.config import (
+    Config,
+    Workers,
+    POOL_ENCODE,
+    POOL_IO,
+    POOL_NETWORK,
+    WORKERS_SECTION,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class NamedExecutor:
+    """A bounded thread pool that records how deep its queue gets and how long work waits"""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.in_flight = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"intercom-{name}"
+        )
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Run func(*args, **kwargs) on this pool, keeping the caller's tracing context"""
+        submitted = monotonic()
+        context = copy_context()
+
+        def call():
+            metrics.record_since(f"intercom.executor.{self.name}.wait", submitted)
+            return context.run(func, *args, **kwargs)
+
+        self.in_flight += 1
+        metrics.adjust(metrics.EXECUTOR_IN_FLIGHT, 1, {"pool": self.name})
+        if self.in_flight > self.workers:
+            logger.debug("%s pool is saturated: %d tasks for %d workers", self.name,
+                         self.in_flight, self.workers)
+        try:
+            return await get_event_loop().run_in_executor(self.executor, call)
+        finally:
+            self.in_flight -= 1
+            metrics.adjust(metrics.EXECUTOR_IN_FLIGHT, -1, {"pool": self.name})
+
+    def shutdown(self):
+        """Stop accepting work and let running tasks finish"""
+        self.executor.shutdown(wait=False)
+
+
+POOLS: Dict[str, NamedExecutor] = {}
+
+
+def setup_executors(cfg: Workers):
+    """Create (or re-create) the worker pools with the configured sizes"""
+    for name, size in (
+            (POOL_NETWORK, cfg.network),
+            (POOL_ENCODE, cfg.encode),
+            (POOL_IO, cfg.io),
+    ):
+        old = POOLS.get(name)
+        if old is not None and old.workers == size:
+            continue
+
+        logger.info("Starting %s worker pool with %d threads", name, size)
+        POOLS[name] = NamedExecutor(name, size)
+        if old is not None:
+            old.shutdown()
+
+
+async def resize_executors(cfg: Config, _previous: Config, changed: Set[str]):
+    """After a config reload, re-create only the pools whose size changed"""
+    if WORKERS_SECTION in changed:
+        setup_executors(cfg.workers)
+
+
+def get_executor(name: str) -> NamedExecutor:
+    """Return the named pool, creating the defaults if setup_executors() wasn't called"""
+    pool = POOLS.get(name)
+    if pool is None:
+        setup_executors(Workers())
+        pool = POOLS[name]
+
+    return pool
+
+
+async def run_in(name: str, func: Callable, *args, **kwargs):
+    """Run a blocking call on the named pool"""
+    return await get_executor(name).run(func, *args, **kwargs)
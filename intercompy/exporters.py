@@ -0,0 +1,70 @@
+"""Telemetry exporters for intercoms that can't (or shouldn't) reach a remote collector"""
+import logging
+import os
+import threading
+from typing import Iterable, Sequence
+
+from opentelemetry.sdk.trace import ReadableSpan
+from opentelemetry.sdk.trace.export import SpanExporter, SpanExportResult
+
+logger = logging.getLogger(__name__)
+
+
+# Shared by the span and metric exporters, so it can't be folded into either one.
+# pylint: disable=too-few-public-methods
+class RotatingJsonLinesFile:
+    """
+    Append JSON documents to a file, one per line, rotating it to numbered backups once it
+    grows past max_bytes. Disk usage is capped at roughly max_bytes * (backups + 1).
+    """
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+
+        parent = os.path.dirname(path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+
+    def write_lines(self, lines: Iterable[str]):
+        """Append the given (already serialized) JSON documents"""
+        with self._lock:
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+
+            with open(self.path, "a", encoding="utf-8") as fhandle:
+                for line in lines:
+                    fhandle.write(line)
+                    fhandle.write("\n")
+
+    def _rotate(self):
+        for idx in range(self.backups - 1, 0, -1):
+            src = f"{self.path}.{idx}"
+            if os.path.exists(src):
+                os.replace(src, f"{self.path}.{idx + 1}")
+
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+class JsonLinesSpanExporter(SpanExporter):
+    """Write finished spans to a rotating local JSONL file, for offline analysis"""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        self.out = RotatingJsonLinesFile(path, max_bytes, backups)
+
+    def export(self, spans: Sequence[ReadableSpan]) -> SpanExportResult:
+        try:
+            self.out.write_lines(span.to_json(indent=None) for span in spans)
+        except OSError as error:
+            logger.error("Failed to write spans to %s: %s", self.out.path, error)
+            return SpanExportResult.FAILURE
+
+        return SpanExportResult.SUCCESS
+
+    def shutdown(self):
+        """Nothing to release; the file is opened per batch"""
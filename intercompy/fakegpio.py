@@ -0,0 +1,143 @@
+"""
+Minimal stand-in for the RPi.GPIO module, for exercising button handling off-Pi.
+
+Only the subset of the API used by intercompy.gpio is implemented. Pins are held at their
+pulled-up (released) level until press() / release() are called, and edge callbacks are
+delivered from a separate thread, the same way RPi.GPIO delivers them.
+"""
+import logging
+import threading
+from queue import Queue
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+BCM = 11
+BOARD = 10
+IN = 1
+OUT = 0
+HIGH = 1
+LOW = 0
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+RPI_INFO = {"P1_REVISION": "fake", "TYPE": "Fake GPIO"}
+
+_LEVELS: Dict[int, int] = {}
+_CALLBACKS: Dict[int, Callable[[int], None]] = {}
+_EDGES: Dict[int, int] = {}
+_EVENTS: Optional[Queue] = None
+_LOCK = threading.Lock()
+
+
+def setwarnings(_flag: bool):
+    """Accepted for API compatibility; does nothing"""
+
+
+def setmode(_mode: int):
+    """Accepted for API compatibility; does nothing"""
+
+
+def setup(pin: int, direction: int, pull_up_down: int = PUD_OFF):
+    """Register a pin, resting at the level implied by its pull-up / pull-down resistor"""
+    if direction != IN:
+        return
+
+    with _LOCK:
+        _LEVELS[pin] = LOW if pull_up_down == PUD_DOWN else HIGH
+
+
+def input(pin: int) -> int:  # pylint: disable=redefined-builtin
+    """Return the current simulated level of a pin"""
+    with _LOCK:
+        return _LEVELS.get(pin, HIGH)
+
+
+def add_event_detect(
+        pin: int, edge: int, callback: Callable[[int], None] = None, bouncetime: int = None
+):
+    """Register an edge callback for a pin. Bounce time is ignored; debounce is the caller's"""
+    logger.debug("Fake event detect on pin %d (edge: %d, bouncetime: %s)", pin, edge,
+                 bouncetime)
+    with _LOCK:
+        _EDGES[pin] = edge
+        if callback is not None:
+            _CALLBACKS[pin] = callback
+
+    _ensure_dispatcher()
+
+
+def remove_event_detect(pin: int):
+    """Stop delivering edge callbacks for a pin"""
+    with _LOCK:
+        _EDGES.pop(pin, None)
+        _CALLBACKS.pop(pin, None)
+
+
+def cleanup(pin: int = None):
+    """Forget pin state and callbacks, for one pin or for all of them"""
+    with _LOCK:
+        if pin is None:
+            _LEVELS.clear()
+            _EDGES.clear()
+            _CALLBACKS.clear()
+        else:
+            _LEVELS.pop(pin, None)
+            _EDGES.pop(pin, None)
+            _CALLBACKS.pop(pin, None)
+
+
+def press(pin: int, bounces: int = 0):
+    """
+    Simulate pushing a (pulled-up) button, which drives the pin low. Pass bounces > 0 to
+    emit extra falling edges, as a worn mechanical switch would.
+    """
+    for _ in range(bounces):
+        _set_level(pin, LOW)
+        _set_level(pin, HIGH)
+
+    _set_level(pin, LOW)
+
+
+def release(pin: int):
+    """Simulate letting go of a (pulled-up) button, which returns the pin high"""
+    _set_level(pin, HIGH)
+
+
+def _set_level(pin: int, level: int):
+    with _LOCK:
+        previous = _LEVELS.get(pin, HIGH)
+        _LEVELS[pin] = level
+        edge = _EDGES.get(pin)
+        callback = _CALLBACKS.get(pin)
+
+    if callback is None or previous == level:
+        return
+
+    if edge == BOTH or (edge == FALLING and level == LOW) or (edge == RISING and level == HIGH):
+        _EVENTS.put((callback, pin))
+
+
+def _ensure_dispatcher():
+    # pylint: disable=global-statement
+    global _EVENTS
+    with _LOCK:
+        if _EVENTS is not None:
+            return
+
+        _EVENTS = Queue()
+
+    threading.Thread(target=_dispatch, name="fakegpio-events", daemon=True).start()
+
+
+def _dispatch():
+    while True:
+        callback, pin = _EVENTS.get()
+        try:
+            callback(pin)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Error in GPIO callback for pin %d: %s", pin, error)
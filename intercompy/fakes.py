@@ -0,0 +1,343 @@
+"""
+Stand-ins for the intercom's hardware and network dependencies: a PyAudio input that replays
+synthetic PCM, a VLC module whose players finish immediately, and a Pyrogram client that
+accepts uploads without touching the network. Used by the benchmarks and load harness so the
+audio and messaging pipelines can run on a plain Linux box.
+"""
+import asyncio
+import os
+import time
+from array import array
+from sys import byteorder
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+from intercompy.testsignal import DEFAULT_RATE, synthetic_speech, to_channels
+
+
+class FakeStream:
+    """A PyAudio input stream replaying a fixed PCM buffer, then silence"""
+
+    def __init__(self, pcm: array, channels: int, rate: int, realtime: bool = False):
+        data = array("h", pcm)
+        if byteorder == "big":
+            data.byteswap()
+
+        self.data = data.tobytes()
+        self.channels = channels
+        self.rate = rate
+        self.realtime = realtime
+        self.position = 0
+        self.closed = False
+
+    def read(self, frames: int, exception_on_overflow: bool = True) -> bytes:
+        """Return the next 'frames' frames, padding with silence once the buffer is spent"""
+        # pylint: disable=unused-argument
+        size = frames * self.channels * 2
+        chunk = self.data[self.position:self.position + size]
+        self.position += size
+        if len(chunk) < size:
+            chunk += b"\0" * (size - len(chunk))
+
+        if self.realtime:
+            # Blocking, like the real device.
+            time.sleep(frames / self.rate)
+
+        return chunk
+
+    def stop_stream(self):
+        """Accepted for API compatibility"""
+
+    def close(self):
+        """Mark the stream closed"""
+        self.closed = True
+
+
+class FakePyAudio:
+    """A PyAudio replacement exposing a single input device backed by synthetic PCM"""
+
+    def __init__(
+            self, pcm: array = None, channels: int = 1, rate: int = DEFAULT_RATE,
+            realtime: bool = False
+    ):
+        self.pcm = synthetic_speech(rate) if pcm is None else pcm
+        self.channels = channels
+        self.rate = rate
+        self.realtime = realtime
+        self.streams: List[FakeStream] = []
+
+    def __call__(self):
+        """Allow an instance to stand in for the PyAudio class itself"""
+        return self
+
+    def device_info(self) -> dict:
+        """Describe the fake input device the way PyAudio does"""
+        return {
+            "index": 0,
+            "name": "fake-input",
+            "maxInputChannels": self.channels,
+            "defaultSampleRate": float(self.rate),
+        }
+
+    def get_default_input_device_info(self) -> dict:
+        """Return the fake input device"""
+        return self.device_info()
+
+    def get_device_count(self) -> int:
+        """There is only the one fake device"""
+        return 1
+
+    def get_device_info_by_index(self, _index: int) -> dict:
+        """Return the fake input device"""
+        return self.device_info()
+
+    def get_sample_size(self, _fmt) -> int:
+        """Samples are always signed 16-bit"""
+        return 2
+
+    def open(self, **kwargs) -> FakeStream:
+        """Open a stream replaying the configured PCM"""
+        channels = kwargs.get("channels", self.channels)
+        stream = FakeStream(
+            to_channels(self.pcm, channels), channels, self.rate, self.realtime
+        )
+        self.streams.append(stream)
+        return stream
+
+    def terminate(self):
+        """Accepted for API compatibility"""
+
+
+class FakeVlcPlayer:
+    """A VLC media player whose playback lasts a fixed time (by default, none at all)"""
+
+    def __init__(self, vlc_module: "FakeVlc"):
+        self.vlc = vlc_module
+        self.media = None
+        self.output_device = None
+        self.started = None
+        self.ended = False
+
+    def set_media(self, media):
+        """Remember the media to play"""
+        self.media = media
+
+    def audio_output_device_set(self, _module, device: str):
+        """Remember the output device"""
+        self.output_device = device
+
+    def play(self):
+        """Record the start of playback"""
+        self.started = time.monotonic()
+        self.vlc.played.append(self.media)
+        self.vlc.active += 1
+        self.vlc.max_active = max(self.vlc.max_active, self.vlc.active)
+
+    def get_state(self):
+        """Report whether the simulated playback time has elapsed"""
+        if self.ended:
+            return self.vlc.State.Ended
+
+        if self.started is None:
+            return self.vlc.State.Stopped
+
+        if time.monotonic() - self.started < self.vlc.play_seconds:
+            return self.vlc.State.Playing
+
+        self.ended = True
+        self.vlc.active -= 1
+        return self.vlc.State.Ended
+
+
+class FakeVlcInstance:
+    """Stand-in for vlc.Instance"""
+
+    def __init__(self, vlc_module: "FakeVlc"):
+        self.vlc = vlc_module
+
+    def media_player_new(self) -> FakeVlcPlayer:
+        """Create a fake player"""
+        return FakeVlcPlayer(self.vlc)
+
+    def media_new(self, filename: str) -> str:
+        """Media is represented by its filename"""
+        return filename
+
+
+class FakeVlc:
+    """Stand-in for the subset of the python-vlc module used by intercompy.audio"""
+
+    State = SimpleNamespace(Ended="Ended", Error="Error", Stopped="Stopped", Playing="Playing")
+
+    def __init__(self, play_seconds: float = 0.0):
+        self.play_seconds = play_seconds
+        self.played: List[str] = []
+        self.active = 0
+        self.max_active = 0
+
+    # pylint: disable=invalid-name
+    def Instance(self, *_args) -> FakeVlcInstance:
+        """Create a fake VLC instance"""
+        return FakeVlcInstance(self)
+
+    def libvlc_audio_set_volume(self, _player, _volume):
+        """Accepted for API compatibility"""
+
+
+class FakeTTS:
+    """
+    Stand-in for gTTS. Synthesis blocks for a fixed time, like the real network call, and
+    saving writes a small placeholder file.
+    """
+
+    synth_seconds = 0.0
+
+    def __init__(self, text: str, **_kwargs):
+        self.text = text
+        time.sleep(self.synth_seconds)
+
+    def write_to_fp(self, fhandle):
+        """Write placeholder audio"""
+        fhandle.write(b"OggS" + self.text.encode("utf-8")[:64])
+
+    def save(self, path: str):
+        """Write placeholder audio to a file"""
+        with open(path, "wb") as fhandle:
+            self.write_to_fp(fhandle)
+
+
+def fake_tts(synth_seconds: float = 0.0):
+    """Return a gTTS stand-in class whose synthesis takes 'synth_seconds'"""
+    return type("FakeTTS", (FakeTTS,), {"synth_seconds": synth_seconds})
+
+
+def install_fake_prompts(prompt_dir: str, prompts):
+    """Register placeholder prompt recordings, so prompt playback never calls gTTS"""
+    # pylint: disable=import-outside-toplevel
+    from intercompy import audio
+
+    for key, _ in prompts:
+        fname = os.path.join(prompt_dir, f"intercom.prompt.{key}.ogg")
+        with open(fname, "wb"):
+            pass
+        audio.RECORDINGS[key] = fname
+
+
+class FakeMessage(SimpleNamespace):
+    """
+    Stand-in for an inbound pyrogram Message, carrying either text or a voice note. Voice
+    downloads write a placeholder file after a simulated delay. Like the other stand-ins here,
+    it is a namespace of the Message attributes the handlers read.
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, message_id: int, user: SimpleNamespace, chat_id: int, *, text: str = None,
+            voice_seconds: float = None, download_seconds: float = 0.0
+    ):
+        voice = None
+        if voice_seconds is not None:
+            voice = SimpleNamespace(
+                mime_type="audio/ogg",
+                duration=voice_seconds,
+                file_id=f"fake-voice-{message_id}",
+                file_unique_id=f"fake{message_id}",
+            )
+
+        super().__init__(
+            id=message_id,
+            from_user=user,
+            chat=SimpleNamespace(id=chat_id),
+            text=text,
+            caption=None,
+            command=None,
+            voice=voice,
+            download_seconds=download_seconds,
+            replies=[],
+        )
+
+    async def download(self, file_name: str = None, **_kwargs) -> str:
+        """Write placeholder voice data to the given file"""
+        await asyncio.sleep(self.download_seconds)
+        with open(file_name, "wb") as fhandle:
+            fhandle.write(b"OggS" + b"\0" * 1024)
+        return file_name
+
+    async def reply_text(self, text: str, **_kwargs):
+        """Remember the reply"""
+        self.replies.append(text)
+
+    async def reply_voice(self, voice=None, **_kwargs):
+        """Remember that a voice reply was sent"""
+        if hasattr(voice, "read"):
+            voice.read()
+        self.replies.append("<voice>")
+
+
+class FakeClient:
+    """
+    A Pyrogram client stand-in that accepts voice and text messages, optionally simulating
+    network latency, and remembers what was sent.
+    """
+
+    def __init__(self, upload_seconds: float = 0.0, send_seconds: float = 0.0):
+        self.upload_seconds = upload_seconds
+        self.send_seconds = send_seconds
+        self.is_connected = True
+        self.uploads = 0
+        self.sent: List[Tuple[str, object, Optional[str]]] = []
+        self.handlers = []
+        self.me = SimpleNamespace(id=1, username="fake_intercom")  # pylint: disable=invalid-name
+
+    async def send_voice(self, chat_id, voice, caption: str = None, **_kwargs):
+        """Accept a voice message as a file path, file object or previously returned file_id"""
+        if hasattr(voice, "read"):
+            voice.read()
+            self.uploads += 1
+            await asyncio.sleep(self.upload_seconds)
+            file_id = f"fake-file-{self.uploads}"
+        elif isinstance(voice, str) and voice.startswith("fake-file-"):
+            await asyncio.sleep(self.send_seconds)
+            file_id = voice
+        else:
+            self.uploads += 1
+            await asyncio.sleep(self.upload_seconds)
+            file_id = f"fake-file-{self.uploads}"
+
+        self.sent.append(("voice", chat_id, caption))
+        return SimpleNamespace(voice=SimpleNamespace(file_id=file_id))
+
+    async def send_message(self, chat_id, text: str, **_kwargs):
+        """Accept a text message"""
+        await asyncio.sleep(self.send_seconds)
+        self.sent.append(("text", chat_id, text))
+        return SimpleNamespace(text=text)
+
+    async def resolve_peer(self, peer_id):
+        """Pretend every peer is already known"""
+        return SimpleNamespace(peer_id=peer_id)
+
+    async def get_me(self):
+        """Return a fake account"""
+        return self.me
+
+    async def get_contacts(self):
+        """There are no contacts"""
+        return []
+
+    async def start(self):
+        """Mark the client connected"""
+        self.is_connected = True
+
+    async def stop(self):
+        """Mark the client disconnected"""
+        self.is_connected = False
+
+    def on_message(self, filters=None, group: int = 0):
+        """Collect handlers the same way Pyrogram's decorator registers them"""
+
+        def decorator(func):
+            self.handlers.append((filters, func, group))
+            return func
+
+        return decorator
@@ -1,30 +1,138 @@
 """Use GPIO edges to drive recording and posting to various chats"""
-from asyncio import sleep
-from typing import Optional
+import logging
+from asyncio import AbstractEventLoop, Queue, Task
+from collections import deque
+from time import monotonic
+from typing import Deque, Dict, List, Optional, Set, Tuple
 
 import opentelemetry
 from pyrogram import Client
 
+from intercompy import fakegpio
 from intercompy.audio import play_impromptu_text
-from intercompy.config import Config, Rolodex
-from intercompy.convo import record_and_send
+from intercompy.config import (
+    Config,
+    Buttons,
+    BUTTONS_BACKEND_FAKE,
+    BUTTONS_SECTION,
+    BUSY_POLICY_REJECT,
+    ROLODEX,
+)
+from intercompy.convo import record_message, send_recording
+from intercompy.replay import REPLAY, play_replay
 from intercompy.tracing import trace
 
+logger = logging.getLogger(__name__)
+
 # pylint: disable=import-error
 LOADED_GPIO = False
 try:
     import RPi.GPIO as gpio
 
     LOADED_GPIO = True
-except RuntimeError as e:
+except (RuntimeError, ImportError) as e:
+    gpio = fakegpio
     print("GPIO unavailable")
     # print(e)
 
 
+def select_backend(name: str):
+    """
+    Switch to the fake GPIO backend when configured to, so button handling can be exercised
+    on machines without Raspberry Pi hardware.
+    """
+    # pylint: disable=global-statement
+    global gpio, LOADED_GPIO
+    if name == BUTTONS_BACKEND_FAKE:
+        print("Using fake GPIO backend")
+        gpio = fakegpio
+        LOADED_GPIO = True
+
+
+class ButtonWatcher:
+    """
+    Bridge edge-triggered GPIO callbacks, which arrive on the GPIO library's own thread, into
+    an asyncio queue of debounced button presses. Each press is queued as (pin, pressed_at,
+    long_press). When long presses are enabled, a press is only queued once it's clear whether
+    the button is still held after the long-press time.
+    """
+
+    def __init__(
+            self, pins: List[int], loop: AbstractEventLoop, debounce_ms: int,
+            long_press_ms: int = 0
+    ):
+        self.pins = pins
+        self.loop = loop
+        self.debounce = debounce_ms / 1000.0
+        self.long_press = long_press_ms / 1000.0
+        self.presses = Queue()
+        self._last_press: Dict[int, float] = {}
+
+    def start(self):
+        """Register for falling edges (buttons pull the pin low) on all watched pins"""
+        for pin in self.pins:
+            gpio.add_event_detect(pin, gpio.FALLING, callback=self._on_edge)
+
+    def stop(self):
+        """Stop receiving edge callbacks"""
+        for pin in self.pins:
+            gpio.remove_event_detect(pin)
+
+    def update(self, pins: List[int], debounce_ms: int, long_press_ms: int = 0):
+        """Watch a new set of pins, touching only the pins that were added or removed"""
+        self.debounce = debounce_ms / 1000.0
+        self.long_press = long_press_ms / 1000.0
+
+        old, new = set(self.pins), set(pins)
+        for pin in old - new:
+            print(f"Releasing PIN #{pin}")
+            gpio.remove_event_detect(pin)
+            gpio.cleanup(pin)
+            self._last_press.pop(pin, None)
+
+        for pin in new - old:
+            print(f"Setting up PIN #{pin} for button input")
+            gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
+            gpio.add_event_detect(pin, gpio.FALLING, callback=self._on_edge)
+
+        self.pins = list(pins)
+
+    def _on_edge(self, pin: int):
+        """Called on the GPIO thread. Hand off to the event loop without doing any work here."""
+        self.loop.call_soon_threadsafe(self._on_press, pin, monotonic())
+
+    def _on_press(self, pin: int, when: float):
+        """
+        Called on the event loop. Drop edges that arrive within the debounce window, and
+        edges from release bounce, where the pin has already settled high again.
+        """
+        last = self._last_press.get(pin)
+        self._last_press[pin] = when
+        if last is not None and when - last < self.debounce:
+            logger.debug("Ignoring bounce on pin %d (%.3fs after last edge)", pin, when - last)
+            return
+
+        if gpio.input(pin) != gpio.LOW:
+            logger.debug("Ignoring edge on pin %d; button is not held", pin)
+            return
+
+        if self.long_press > 0:
+            self.loop.call_later(self.long_press, self._on_hold_timeout, pin, when)
+        else:
+            self.presses.put_nowait((pin, when, False))
+
+    def _on_hold_timeout(self, pin: int, when: float):
+        """Called on the event loop, once the long-press time has passed since a press"""
+        held = gpio.input(pin) == gpio.LOW
+        self.presses.put_nowait((pin, when, held))
+
+
 # pylint: disable=no-member
 @trace
-def init_pins(cfg: Rolodex):
+def init_pins(cfg: Config):
     """Setup GPIO pins"""
+    select_backend(cfg.buttons.backend)
+
     if not LOADED_GPIO:
         opentelemetry.trace.get_current_span().set_attribute("gpio.loaded", 0)
         print("No GPIO available. Skipping")
@@ -33,47 +141,189 @@ def init_pins(cfg: Rolodex):
     opentelemetry.trace.get_current_span().set_attributes({
         "gpio.loaded": 1,
         "rpi-version": gpio.RPI_INFO['P1_REVISION'],
-        "gpio.pin-count": len(cfg.get_pins())
+        "gpio.pin-count": len(cfg.rolodex.get_pins())
     })
 
     print(f"Detected Raspberry Pi {gpio.RPI_INFO['P1_REVISION']}.")
 
     gpio.setwarnings(True)
     gpio.setmode(gpio.BCM)
-    for pin in cfg.get_pins():
+    for pin in cfg.rolodex.get_pins():
         print(f"Setting up PIN #{pin} for button input")
         gpio.setup(pin, gpio.IN, pull_up_down=gpio.PUD_UP)
 
 
-@trace
-async def button_pushed(pin: int, cfg: Config, client: Optional[Client]):
+class PressQueue:
     """
-    When a rolodex button is pushed, respond appropriately based on whether Telegram is
-    available.
+    The button whose recording is active, whether it was pressed again to stop, and the
+    presses on other buttons that wait for it under the busy policy.
     """
-    target = cfg.rolodex.get_pin_target(pin)
 
-    opentelemetry.trace.get_current_span().set_attributes({
-        "gpio.pushed-pin": pin,
-        "telegram.connected": client and client.is_connected
-    })
+    def __init__(self):
+        self.active_pin: Optional[int] = None
+        self.stop_requested = False
+        self.pending: Deque[Tuple[int, float]] = deque()
+
+    def activate(self, pin: int):
+        """Mark a button's recording as the active one"""
+        self.active_pin = pin
+        self.stop_requested = False
+
+    def offer(self, pin: int, pressed_at: float, cfg: Buttons):
+        """Queue or reject a press on another button while a recording is active"""
+        if cfg.busy_policy == BUSY_POLICY_REJECT:
+            logger.info("Rejecting press on pin %d; recording from pin %d is active", pin,
+                        self.active_pin)
+        elif any(queued == pin for queued, _ in self.pending):
+            logger.debug("Press on pin %d is already queued", pin)
+        elif len(self.pending) >= cfg.queue_size:
+            logger.warning("Dropping press on pin %d; %d presses already queued", pin,
+                           len(self.pending))
+        else:
+            logger.info("Queueing press on pin %d until pin %d finishes recording", pin,
+                        self.active_pin)
+            self.pending.append((pin, pressed_at))
+
+    def finish(self) -> Optional[Tuple[int, float]]:
+        """End the active recording, returning the next queued press, if any"""
+        self.active_pin = None
+        return self.pending.popleft() if self.pending else None
+
+
+class SessionManager:
+    """
+    Own the single active recording session for one room's buttons. Each room has its own
+    manager, so rooms record independently of each other.
+
+    Pressing the button that started the active recording stops it. Presses on other buttons
+    while a recording is active are queued or rejected, according to the configured busy
+    policy. Once a recording is captured, the microphone is released for the next session,
+    and encoding / transcription / sending continue in the background.
+    """
+
+    def __init__(
+            self, cfg: Config, client: Optional[Client], loop: AbstractEventLoop,
+            room: Optional[str] = None
+    ):
+        self.cfg = cfg
+        self.client = client
+        self.loop = loop
+        self.room = room
+        self.presses = PressQueue()
+        self.background: Set[Task] = set()
+
+    def press(self, pin: int, pressed_at: Optional[float] = None):
+        """Handle a debounced button press. Never blocks."""
+        if pressed_at is None:
+            pressed_at = monotonic()
+
+        if self.presses.active_pin is None:
+            self._start(pin, pressed_at)
+        elif pin == self.presses.active_pin:
+            logger.info("Button %d pressed again; stopping recording", pin)
+            self.presses.stop_requested = True
+        else:
+            self.presses.offer(pin, pressed_at, self.cfg.buttons)
+
+    def long_press(self, pin: int):
+        """Replay the room's last received message, unless the room is busy recording"""
+        if self.presses.active_pin is not None:
+            logger.info("Ignoring long press on pin %d; recording from pin %d is active", pin,
+                        self.presses.active_pin)
+            return
+
+        room = self.cfg.get_room(self.room) or self.cfg.get_room()
+        entries = REPLAY.recent(1, room.name)
+        if not entries:
+            logger.info("Long press on pin %d, but there is nothing to replay", pin)
+            return
+
+        self._in_background(play_replay(entries, self.cfg, room))
+
+    def _start(self, pin: int, pressed_at: float):
+        self.presses.activate(pin)
+        self._in_background(self._run_session(pin, pressed_at))
+
+    async def _should_stop(self) -> bool:
+        """Passed to the recorder as stop_fn"""
+        return self.presses.stop_requested
+
+    @trace
+    async def _run_session(self, pin: int, pressed_at: float):
+        """Record for one button press, then hand the result off to a background task"""
+        targets = self.cfg.rolodex.get_pin_targets(pin)
+        client = self.client
+        # The room may have been removed by a config reload since the press was queued.
+        room = self.cfg.get_room(self.room) or self.cfg.get_room()
+
+        opentelemetry.trace.get_current_span().set_attributes({
+            "gpio.pushed-pin": pin,
+            "room": room.name,
+            "gpio.target-count": len(targets),
+            "gpio.queued-presses": len(self.presses.pending),
+            "telegram.connected": bool(client and client.is_connected)
+        })
+
+        print(f"PIN: {pin}, Targets: {targets} ({self.cfg.rolodex.get_pin_alias(pin)})")
+        try:
+            if client and client.is_connected:
+                recording = await record_message(self.cfg, self._should_stop, pressed_at, room)
+                self._in_background(send_recording(targets, recording, client, self.cfg, room))
+            else:
+                print("Cannot send to Telegram, client is disconnected!")
+                await play_impromptu_text("Sorry. Telegram is disconnected.", room.audio)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Recording for pin %d failed: %s", pin, error)
+        finally:
+            queued = self.presses.finish()
+            if queued is not None:
+                self._start(*queued)
+
+    def _in_background(self, coro):
+        task = self.loop.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self._background_done)
+
+    def _background_done(self, task: Task):
+        self.background.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Background task failed: %s", task.exception())
+
+
+async def watch_buttons(cfg: Config, client: Optional[Client], loop: AbstractEventLoop):
+    """
+    Wait for debounced button presses on all pins listed in the rolodex config, and hand
+    them to the session manager of the room each button is in. The loop sleeps until the GPIO
+    library reports an edge, so there is no polling while idle. Long presses replay the room's
+    last received message.
+    """
+    sessions: Dict[str, SessionManager] = {}
+    watcher = ButtonWatcher(cfg.rolodex.get_pins(), loop, cfg.buttons.debounce_ms,
+                            cfg.buttons.long_press_ms)
+    watcher.start()
 
-    print(f"PIN: {pin}, Target: {target} ({cfg.rolodex.get_pin_alias(pin)})")
-    if client and client.is_connected:
-        await record_and_send(target, client, cfg)
-    else:
-        print("Cannot send to Telegram, client is disconnected!")
-        await play_impromptu_text("Sorry. Telegram is disconnected.", cfg.audio)
+    async def on_reload(new_cfg: Config, _previous: Config, changed: Set[str]):
+        if changed.intersection((ROLODEX, BUTTONS_SECTION)):
+            watcher.update(new_cfg.rolodex.get_pins(), new_cfg.buttons.debounce_ms,
+                           new_cfg.buttons.long_press_ms)
 
+    cfg.add_listener(on_reload)
+    try:
+        while True:
+            pin, pressed_at, long_press = await watcher.presses.get()
 
-async def scan_buttons(cfg: Config, client: Optional[Client]):
-    """Setup a scanning loop for all buttons listed in the rolodex config."""
-    while True:
-        for pin in cfg.rolodex.get_pins():
-            if gpio.input(pin) == 0:
-                await button_pushed(pin, cfg, client)
+            room = cfg.get_pin_room(pin)
+            session = sessions.get(room.name)
+            if session is None:
+                session = SessionManager(cfg, client, loop, room.name)
+                sessions[room.name] = session
 
-        await sleep(0.1)
+            if long_press:
+                session.long_press(pin)
+            else:
+                session.press(pin, pressed_at)
+    finally:
+        watcher.stop()
 
 
 async def listen_for_pins(client: Optional[Client], cfg: Config, loop):
@@ -81,5 +331,5 @@ async def listen_for_pins(client: Optional[Client], cfg: Config, loop):
     if not LOADED_GPIO:
         return
 
-    loop.create_task(scan_buttons(cfg, client))
+    loop.create_task(watch_buttons(cfg, client, loop))
     print("Listening for button input...")
@@ -0,0 +1,353 @@
+"""
+Inbound load generator and replay harness.
+
+Drives the message handlers registered by convo.start_telegram with a stand-in Telegram
+client, feeding them a scripted (or replayed) stream of text and voice updates. Reports
+per-message latency, playback backlog, memory growth and leftover temp files as JSON.
+"""
+import glob
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from asyncio import Semaphore, ensure_future, gather, new_event_loop, sleep
+from contextlib import ExitStack
+from datetime import datetime
+from time import monotonic
+from types import SimpleNamespace
+from typing import List, Optional
+from unittest import mock
+
+import click
+
+from intercompy import audio, convo, metrics, replay, spool
+from intercompy.bench import summarize, write_report
+from intercompy.config import Config, Replay, Spool, load_config
+from intercompy.fakes import FakeClient, FakeMessage, FakeVlc, fake_tts, install_fake_prompts
+
+KIND_TEXT = "text"
+KIND_VOICE = "voice"
+
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+SAMPLE_TEXTS = [
+    "Dinner's ready!",
+    "Can someone let the dog out? Thanks.",
+    "Running late, be home at 7. Check https://example.com/traffic for the mess on the highway.",
+    "ok",
+    "Did anyone see my keys?? I left them on the counter...",
+]
+
+FAKE_USERS = [
+    SimpleNamespace(id=1001, username="alice", first_name="Alice", last_name="User"),
+    SimpleNamespace(id=1002, username="bob", first_name="Bob", last_name=None),
+    SimpleNamespace(id=1003, username=None, first_name="Carol", last_name="Other"),
+]
+
+
+# pylint: disable=too-few-public-methods
+class Event:
+    """One inbound update, scheduled 'at' seconds after the start of the run"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, at: float, kind: str, user: SimpleNamespace, text: str = None,
+            voice_seconds: float = None
+    ):
+        self.at = at  # pylint: disable=invalid-name
+        self.kind = kind
+        self.user = user
+        self.text = text
+        self.voice_seconds = voice_seconds
+
+
+def scripted_events(
+        duration: float, text_rate: float, voice_rate: float, seed: int = 42
+) -> List[Event]:
+    """
+    Generate Poisson arrivals of text and voice updates at the given rates (per second),
+    over 'duration' seconds.
+    """
+    rng = random.Random(seed)
+    events = []
+    for kind, rate in ((KIND_TEXT, text_rate), (KIND_VOICE, voice_rate)):
+        if rate <= 0:
+            continue
+
+        at = rng.expovariate(rate)
+        while at < duration:
+            user = rng.choice(FAKE_USERS)
+            if kind == KIND_TEXT:
+                events.append(Event(at, kind, user, text=rng.choice(SAMPLE_TEXTS)))
+            else:
+                events.append(Event(at, kind, user, voice_seconds=rng.uniform(1.0, 8.0)))
+            at += rng.expovariate(rate)
+
+    return sorted(events, key=lambda e: e.at)
+
+
+def load_replay(path: str) -> List[Event]:
+    """
+    Load captured traffic. Accepts either JSON lines of the form
+        {"at": 1.5, "kind": "text", "text": "...", "user_id": 1, "username": "alice",
+         "first_name": "Alice", "last_name": "User", "voice_seconds": 3.2}
+    or a Telegram Desktop chat export (result.json).
+    """
+    with open(path, encoding="utf-8") as fhandle:
+        content = fhandle.read()
+
+    stripped = content.lstrip()
+    if stripped.startswith("{") and '"messages"' in stripped[:4096]:
+        try:
+            return _events_from_telegram_export(json.loads(content))
+        except ValueError:
+            pass
+
+    events = []
+    for line in content.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+
+        data = json.loads(line)
+        user = SimpleNamespace(
+            id=data.get("user_id"),
+            username=data.get("username"),
+            first_name=data.get("first_name") or "Someone",
+            last_name=data.get("last_name"),
+        )
+        events.append(
+            Event(float(data.get("at", 0)), data.get("kind", KIND_TEXT), user,
+                  text=data.get("text"), voice_seconds=data.get("voice_seconds"))
+        )
+
+    return sorted(events, key=lambda e: e.at)
+
+
+def _events_from_telegram_export(export: dict) -> List[Event]:
+    events = []
+    start = None
+    for msg in export.get("messages", []):
+        if msg.get("type") != "message":
+            continue
+
+        when = datetime.fromisoformat(msg["date"]).timestamp()
+        start = when if start is None else start
+
+        from_id = str(msg.get("from_id") or "")
+        user_id = int(from_id[4:]) if from_id.startswith("user") else None
+        names = (msg.get("from") or "Someone").split(" ", 1)
+        user = SimpleNamespace(
+            id=user_id, username=None, first_name=names[0],
+            last_name=names[1] if len(names) > 1 else None,
+        )
+
+        if msg.get("media_type") == "voice_message":
+            events.append(Event(when - start, KIND_VOICE, user,
+                                voice_seconds=float(msg.get("duration_seconds") or 3)))
+            continue
+
+        text = msg.get("text")
+        if isinstance(text, list):
+            text = "".join(part if isinstance(part, str) else part.get("text", "")
+                           for part in text)
+        if text:
+            events.append(Event(when - start, KIND_TEXT, user, text=text))
+
+    return sorted(events, key=lambda e: e.at)
+
+
+# pylint: disable=too-many-instance-attributes
+class Harness:
+    """Deliver events to the registered handlers and collect measurements"""
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+            self, cfg: Config, *, workers: int = DEFAULT_WORKERS, speed: float = 1.0,
+            download_seconds: float = 0.2, synth_seconds: float = 0.3,
+            play_seconds: float = 2.0
+    ):
+        self.cfg = cfg
+        self.workers = workers
+        self.speed = speed
+        self.download_seconds = download_seconds
+        self.synth_seconds = synth_seconds
+        self.vlc = FakeVlc(play_seconds)
+        self.client = FakeClient()
+        self.latencies = {KIND_TEXT: [], KIND_VOICE: []}
+        self.backlog: List[int] = []
+        self.errors = 0
+        self._next_id = 0
+
+    async def run(self, events: List[Event]) -> dict:
+        """Play the events against the handlers, returning the report"""
+        await convo.start_telegram(self.client, self.cfg)
+
+        temp_before = set(_intercom_temp_files())
+        tracemalloc.start()
+        mem_before, _ = tracemalloc.get_traced_memory()
+
+        sampling = [True]
+        sampler = ensure_future(self._sample_backlog(sampling))
+        elapsed = await self._deliver_all(events)
+        sampling[0] = False
+        await sampler
+
+        mem_after, mem_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        leaked = sorted(set(_intercom_temp_files()) - temp_before)
+
+        first_audio = metrics.SAMPLES.get(metrics.INBOUND_RECEIVED_TO_AUDIO)
+        return {
+            "messages": len(events),
+            "errors": self.errors,
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(len(events) / elapsed, 3) if elapsed else None,
+            "latency": {
+                kind: summarize(samples) for kind, samples in self.latencies.items() if samples
+            },
+            "first_audio": summarize(list(first_audio)) if first_audio else None,
+            "playback": {
+                "max_overlapping": self.vlc.max_active,
+                "max_backlog": max(self.backlog or [0]),
+                "mean_backlog": round(sum(self.backlog) / len(self.backlog), 3)
+                if self.backlog else 0,
+            },
+            "memory": {
+                "growth_bytes": mem_after - mem_before,
+                "peak_bytes": mem_peak,
+                "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            },
+            "leaked_temp_files": leaked,
+        }
+
+    async def _deliver_all(self, events: List[Event]) -> float:
+        """Deliver each event on schedule, returning the seconds until all were handled"""
+        slots = Semaphore(self.workers)
+        started = monotonic()
+
+        deliveries = []
+        for event in events:
+            delay = event.at / self.speed - (monotonic() - started)
+            if delay > 0:
+                await sleep(delay)
+            deliveries.append(ensure_future(self._deliver(event, slots)))
+
+        await gather(*deliveries)
+        return monotonic() - started
+
+    async def _deliver(self, event: Event, slots: Semaphore):
+        self._next_id += 1
+        message = FakeMessage(
+            self._next_id, event.user, 0, text=event.text,
+            voice_seconds=event.voice_seconds if event.kind == KIND_VOICE else None,
+            download_seconds=self.download_seconds,
+        )
+
+        arrived = monotonic()
+        async with slots:
+            try:
+                await self._dispatch(message)
+            except Exception as error:  # pylint: disable=broad-except
+                self.errors += 1
+                print(f"Handler failed for message {message.id}: {error}", file=sys.stderr)
+
+        self.latencies.setdefault(event.kind, []).append((monotonic() - arrived) * 1000.0)
+
+    async def _dispatch(self, message: FakeMessage):
+        """Run the first handler whose filter matches, as Pyrogram does within a group"""
+        for flt, handler, _group in self.client.handlers:
+            if flt is None or await flt(self.client, message):
+                await handler(self.client, message)
+                return
+
+    async def _sample_backlog(self, sampling: List[bool]):
+        while sampling[0]:
+            self.backlog.append(self.vlc.active)
+            await sleep(0.1)
+
+
+def _intercom_temp_files() -> List[str]:
+    return [
+        path for directory in (tempfile.gettempdir(), spool.SPOOL.spool_dir)
+        for path in glob.glob(os.path.join(directory, "intercom.*"))
+    ]
+
+
+def run_load(
+        cfg: Config, events: List[Event], workdir: str, harness_args: Optional[dict] = None
+) -> dict:
+    """Run the harness with hardware and network stand-ins in place"""
+    harness = Harness(cfg, **(harness_args or {}))
+    loop = new_event_loop()
+    with ExitStack() as patches:
+        patches.enter_context(mock.patch.object(audio, "vlc", harness.vlc))
+        patches.enter_context(mock.patch.object(audio, "tts", fake_tts(harness.synth_seconds)))
+        install_fake_prompts(workdir, audio.PROMPTS)
+        spool.setup_spool(Spool({"dir": os.path.join(workdir, "spool")}))
+        replay.setup_replay(Replay({
+            "dir": os.path.join(workdir, "replay"),
+            "max-messages": cfg.replay.max_messages,
+            "max-bytes": cfg.replay.max_bytes,
+        }))
+        try:
+            report = loop.run_until_complete(harness.run(events))
+        finally:
+            loop.close()
+
+    report["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    return report
+
+
+# pylint: disable=too-many-arguments
+@click.command()
+@click.option("--config-file", "-f", help="Use this config.yaml (rolodex, audio settings)")
+@click.option(
+    "--replay", "-r", "replay_file",
+    help="Replay captured traffic (JSON lines or Telegram export)"
+)
+@click.option("--duration", "-d", default=30.0, help="Seconds of scripted traffic")
+@click.option("--text-rate", default=0.5, help="Scripted text messages per second")
+@click.option("--voice-rate", default=0.2, help="Scripted voice messages per second")
+@click.option("--speed", default=1.0, help="Time compression factor for the schedule")
+@click.option("--workers", default=DEFAULT_WORKERS, help="Concurrent handler invocations")
+@click.option("--download-seconds", default=0.2, help="Simulated voice download time")
+@click.option("--synth-seconds", default=0.3, help="Simulated (blocking) TTS time")
+@click.option("--play-seconds", default=2.0, help="Simulated playback time per clip")
+@click.option("--output", "-o", help="Write JSON results to this file instead of stdout")
+def run(
+        *, config_file: str = None, replay_file: str = None, duration: float = 30.0,
+        text_rate: float = 0.5, voice_rate: float = 0.2, speed: float = 1.0,
+        workers: int = DEFAULT_WORKERS, download_seconds: float = 0.2,
+        synth_seconds: float = 0.3, play_seconds: float = 2.0, output: str = None
+):
+    """Measure inbound message throughput and stability with a stand-in Telegram client"""
+    if replay_file:
+        events = load_replay(replay_file)
+    else:
+        events = scripted_events(duration, text_rate, voice_rate)
+    print(f"Delivering {len(events)} inbound updates", file=sys.stderr)
+
+    with tempfile.TemporaryDirectory(prefix="intercom.loadgen.") as workdir:
+        if config_file:
+            cfg = load_config(config_file)
+        else:
+            cfg = Config({"telegram": {"chat": "loadgen"}}, workdir)
+
+        report = run_load(cfg, events, workdir, {
+            "workers": workers,
+            "speed": speed,
+            "download_seconds": download_seconds,
+            "synth_seconds": synth_seconds,
+            "play_seconds": play_seconds,
+        })
+
+    write_report(report, output)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,257 @@
+"""
+Latency metrics for the outbound (button -> Telegram) and inbound (Telegram -> speaker) paths.
+
+Durations are recorded into OpenTelemetry histograms, exported through the exporter configured
+in the tracing section, and also kept in a small in-process window of recent samples so p50 /
+p95 can be read on the device itself (see the /stats chat command).
+"""
+import logging
+import math
+from collections import deque
+from contextvars import ContextVar
+from time import monotonic
+from typing import Deque, Dict, List, Optional, Sequence
+
+import opentelemetry
+from opentelemetry.exporter.otlp.proto.http.metric_exporter import OTLPMetricExporter
+from opentelemetry.sdk.metrics import Histogram, MeterProvider
+from opentelemetry.sdk.metrics.export import (
+    ConsoleMetricExporter,
+    MetricExporter,
+    MetricExportResult,
+    MetricsData,
+    PeriodicExportingMetricReader,
+)
+from opentelemetry.sdk.metrics.view import ExplicitBucketHistogramAggregation, View
+from opentelemetry.sdk.resources import Resource
+
+from intercompy.config import Tracing, EXPORTER_CONSOLE, EXPORTER_FILE, OTLP_METRICS
+from intercompy.exporters import RotatingJsonLinesFile
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_PRESS_TO_CAPTURE = "intercom.outbound.press_to_capture"
+OUTBOUND_CAPTURE_TO_ENCODED = "intercom.outbound.capture_to_encoded"
+OUTBOUND_ENCODED_TO_SENT = "intercom.outbound.encoded_to_sent"
+OUTBOUND_TRANSCRIPTION = "intercom.outbound.transcription"
+INBOUND_RECEIVED_TO_AUDIO = "intercom.inbound.received_to_audio"
+INBOUND_DOWNLOAD = "intercom.inbound.download"
+INBOUND_SYNTHESIS = "intercom.inbound.synthesis"
+LOOP_LAG = "intercom.loop.lag"
+
+OUTBOUND_MESSAGES = "intercom.outbound.messages"
+OUTBOUND_FAILURES = "intercom.outbound.failures"
+INBOUND_MESSAGES = "intercom.inbound.messages"
+LOOP_STALLS = "intercom.loop.stalls"
+EXECUTOR_IN_FLIGHT = "intercom.executor.in_flight"
+SPOOL_REJECTED = "intercom.spool.rejected"
+REPLAY_PLAYS = "intercom.replay.plays"
+REPLAY_EVICTED = "intercom.replay.evicted"
+
+DURATIONS = (
+    OUTBOUND_PRESS_TO_CAPTURE,
+    OUTBOUND_CAPTURE_TO_ENCODED,
+    OUTBOUND_ENCODED_TO_SENT,
+    OUTBOUND_TRANSCRIPTION,
+    INBOUND_RECEIVED_TO_AUDIO,
+    INBOUND_DOWNLOAD,
+    INBOUND_SYNTHESIS,
+    LOOP_LAG,
+)
+
+# Milliseconds; most of these phases are measured in seconds, not the SDK's default sub-second
+# buckets.
+LATENCY_BUCKETS_MS = (
+    10, 25, 50, 100, 250, 500, 750, 1000, 1500, 2000, 3000, 5000, 7500, 10000, 15000, 30000,
+    60000,
+)
+
+# pylint: disable=global-statement
+SAMPLE_WINDOW = 500
+SAMPLES: Dict[str, Deque[float]] = {}
+COUNTS: Dict[str, int] = {}
+INSTRUMENTS = {}
+
+_INBOUND_STARTED: ContextVar = ContextVar("intercompy_inbound_started", default=None)
+
+
+class JsonLinesMetricExporter(MetricExporter):
+    """Write metric snapshots to a rotating local JSONL file, for offline analysis"""
+
+    def __init__(self, path: str, max_bytes: int, backups: int):
+        super().__init__()
+        self.out = RotatingJsonLinesFile(path, max_bytes, backups)
+
+    def export(
+            self, metrics_data: MetricsData, timeout_millis: float = 10_000, **kwargs
+    ) -> MetricExportResult:
+        try:
+            self.out.write_lines([metrics_data.to_json(indent=None)])
+        except OSError as error:
+            logger.error("Failed to write metrics to %s: %s", self.out.path, error)
+            return MetricExportResult.FAILURE
+
+        return MetricExportResult.SUCCESS
+
+    def force_flush(self, timeout_millis: float = 10_000) -> bool:
+        return True
+
+    def shutdown(self, timeout_millis: float = 30_000, **kwargs):
+        """Nothing to release; the file is opened per export"""
+
+
+def setup_metrics(cfg: Tracing):
+    """Setup the OpenTelemetry meter provider, using the same exporter choice as tracing"""
+    global SAMPLE_WINDOW
+    SAMPLE_WINDOW = cfg.metrics_samples
+
+    readers = []
+    exporter = _metric_exporter(cfg)
+    if exporter is not None:
+        readers.append(
+            PeriodicExportingMetricReader(
+                exporter,
+                export_interval_millis=cfg.metrics_interval_ms,
+                export_timeout_millis=cfg.export_timeout_ms,
+            )
+        )
+
+    resource = Resource.create({
+        "service.name": "intercompy",
+        "intercom.name": cfg.intercom_name or "unknown",
+    })
+    view = View(
+        instrument_type=Histogram,
+        aggregation=ExplicitBucketHistogramAggregation(LATENCY_BUCKETS_MS),
+    )
+    opentelemetry.metrics.set_meter_provider(
+        MeterProvider(resource=resource, metric_readers=readers, views=[view])
+    )
+
+
+def _metric_exporter(cfg: Tracing) -> Optional[MetricExporter]:
+    """The configured metric exporter, or None if telemetry is disabled"""
+    if not cfg.enabled:
+        return None
+
+    if cfg.exporter == EXPORTER_FILE:
+        print(f"Writing metrics to: {cfg.metrics_file}")
+        return JsonLinesMetricExporter(cfg.metrics_file, cfg.file_max_bytes, cfg.file_backups)
+
+    if cfg.exporter == EXPORTER_CONSOLE:
+        return ConsoleMetricExporter()
+
+    print(f"Exporting metrics to: {cfg.otlp_endpoint(OTLP_METRICS)}")
+    return OTLPMetricExporter(
+        endpoint=cfg.otlp_endpoint(OTLP_METRICS),
+        timeout=max(cfg.export_timeout_ms // 1000, 1),
+    )
+
+
+def _meter():
+    return opentelemetry.metrics.get_meter("intercompy")
+
+
+def record_duration(name: str, seconds: float, attributes: dict = None):
+    """Record how long a phase took, in the histogram named 'name'"""
+    millis = seconds * 1000.0
+
+    histogram = INSTRUMENTS.get(name)
+    if histogram is None:
+        histogram = _meter().create_histogram(name, unit="ms")
+        INSTRUMENTS[name] = histogram
+
+    histogram.record(millis, attributes=attributes)
+
+    samples = SAMPLES.get(name)
+    if samples is None or samples.maxlen != SAMPLE_WINDOW:
+        samples = deque(samples or (), maxlen=SAMPLE_WINDOW)
+        SAMPLES[name] = samples
+
+    samples.append(millis)
+
+
+def record_since(name: str, started: float, attributes: dict = None):
+    """Record the time elapsed since a monotonic() timestamp"""
+    record_duration(name, monotonic() - started, attributes)
+
+
+def count(name: str, value: int = 1, attributes: dict = None):
+    """Increment the counter named 'name'"""
+    counter = INSTRUMENTS.get(name)
+    if counter is None:
+        counter = _meter().create_counter(name)
+        INSTRUMENTS[name] = counter
+
+    counter.add(value, attributes=attributes)
+    COUNTS[name] = COUNTS.get(name, 0) + value
+
+
+def adjust(name: str, delta: int, attributes: dict = None):
+    """Move the up/down counter named 'name', e.g. to track queue depth"""
+    gauge = INSTRUMENTS.get(name)
+    if gauge is None:
+        gauge = _meter().create_up_down_counter(name)
+        INSTRUMENTS[name] = gauge
+
+    gauge.add(delta, attributes=attributes)
+
+
+class Timer:
+    """Context manager recording the duration of a block into a histogram"""
+
+    def __init__(self, name: str, attributes: dict = None):
+        self.name = name
+        self.attributes = attributes
+        self.started = None
+
+    def __enter__(self):
+        self.started = monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        record_since(self.name, self.started, self.attributes)
+
+
+def begin_inbound(received_at: float = None):
+    """
+    Mark the start of handling an inbound Telegram update. The next audio played from the
+    same task is recorded as that update's time-to-first-audio.
+    """
+    _INBOUND_STARTED.set([monotonic() if received_at is None else received_at])
+
+
+def audio_started():
+    """Called when playback actually starts; closes out any pending inbound measurement"""
+    pending = _INBOUND_STARTED.get()
+    if pending:
+        record_since(INBOUND_RECEIVED_TO_AUDIO, pending.pop())
+
+
+def percentile(samples: Sequence[float], pct: float) -> float:
+    """Nearest-rank percentile of the given samples"""
+    ordered = sorted(samples)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def format_stats() -> str:
+    """Summarize recent latency samples and counters for display in chat"""
+    lines: List[str] = []
+    for name in list(DURATIONS) + sorted(set(SAMPLES) - set(DURATIONS)):
+        samples = SAMPLES.get(name)
+        if not samples:
+            continue
+
+        lines.append(
+            f"{name}: p50={percentile(samples, 50):.0f}ms p95={percentile(samples, 95):.0f}ms "
+            f"(n={len(samples)})"
+        )
+
+    for name, value in sorted(COUNTS.items()):
+        lines.append(f"{name}: {value}")
+
+    if not lines:
+        return "No latency samples recorded yet."
+
+    return "\n".join(lines)
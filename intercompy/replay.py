@@ -0,0 +1,180 @@
+"""
+A bounded cache of recently received messages, so that anyone who missed one can hear it again
+without asking the sender to resend it.
+
+Inbound voice notes, and the speech synthesized for texts and announcements, are moved here
+once they're ready to play, instead of being deleted. A replay plays these files as they are:
+nothing is downloaded or synthesized again. The oldest messages are evicted once the cache holds
+more than 'max-messages' messages or 'max-bytes' of audio. The cache is emptied at startup.
+"""
+import logging
+import os
+import shutil
+from asyncio import gather
+from collections import deque
+from itertools import count
+from time import time
+from typing import Deque, List, Optional, Tuple
+
+from intercompy import metrics
+from intercompy.audio import playback_ogg
+from intercompy.config import Config, Replay, Room, POOL_IO
+from intercompy.executors import run_in
+
+logger = logging.getLogger(__name__)
+
+KIND_VOICE = "voice"
+KIND_TEXT = "text"
+
+
+# pylint: disable=too-few-public-methods
+class ReplayEntry:
+    """One cached message: its sound files in playing order, and the rooms it played in"""
+
+    def __init__(self, entry_id: int, kind: str, sender: str, rooms: List[str]):
+        self.entry_id = entry_id
+        self.kind = kind
+        self.sender = sender
+        self.rooms = rooms
+        self.received_at = time()
+        self.parts: List[Tuple[str, Optional[int]]] = []
+        self.size = 0
+
+    def __repr__(self):
+        return f"ReplayEntry({self.entry_id}, {self.kind!r}, from={self.sender!r})"
+
+
+class ReplayCache:
+    """The cached messages, oldest first, and the files that hold them"""
+
+    def __init__(self, cfg: Replay = None):
+        self.cfg = cfg or Replay()
+        self.entries: Deque[ReplayEntry] = deque()
+        self.total_bytes = 0
+        self._ids = count(1)
+
+    def configure(self, cfg: Replay, clean: bool = False):
+        """
+        Apply the config. With 'clean' (only when the intercom itself starts), also remove
+        anything left over from a previous run.
+        """
+        self.cfg = cfg
+        self.entries.clear()
+        self.total_bytes = 0
+
+        if not cfg.enabled:
+            logger.info("Replay cache is disabled")
+            return
+
+        os.makedirs(cfg.replay_dir, exist_ok=True)
+        if not clean:
+            return
+
+        with os.scandir(cfg.replay_dir) as found:
+            for entry in found:
+                if entry.is_file(follow_symlinks=False):
+                    os.remove(entry.path)
+
+        logger.info("Keeping up to %d messages (%d bytes) for replay in %s",
+                    cfg.max_messages, cfg.max_bytes, cfg.replay_dir)
+
+    def add(self, kind: str, sender: str, rooms: List[str]) -> Optional[ReplayEntry]:
+        """Start caching a new message. Returns None if the cache is disabled."""
+        if not self.cfg.enabled:
+            return None
+
+        entry = ReplayEntry(next(self._ids), kind, sender, rooms)
+        self.entries.append(entry)
+        self._evict(entry)
+        return entry
+
+    async def keep(
+            self, entry: Optional[ReplayEntry], path: str, volume: Optional[int] = None
+    ) -> str:
+        """
+        Move a sound file that is about to be played into the cache, as the next part of the
+        message. Returns the path to play it from: the cached file, or the original path if
+        it isn't kept (the cache is disabled, or the message is too big for it). The file
+        work runs on the io pool.
+        """
+        if entry is None or entry not in self.entries:
+            return path
+
+        size = await run_in(POOL_IO, os.path.getsize, path)
+        if entry.size + size > self.cfg.max_bytes:
+            logger.info("Message %d is too large to keep for replay", entry.entry_id)
+            self._drop(entry)
+            return path
+
+        _, ext = os.path.splitext(path)
+        cached = os.path.join(self.cfg.replay_dir, f"{entry.entry_id}-{len(entry.parts)}{ext}")
+        await run_in(POOL_IO, shutil.move, path, cached)
+        if entry not in self.entries:
+            # Evicted while the file was moving; don't leave it behind in the cache.
+            await run_in(POOL_IO, shutil.move, cached, path)
+            return path
+
+        entry.parts.append((cached, volume))
+        entry.size += size
+        self.total_bytes += size
+        self._evict(entry)
+        return cached
+
+    def recent(self, limit: int = 1, room: Optional[str] = None) -> List[ReplayEntry]:
+        """The last 'limit' complete messages (oldest first), optionally only those in a room"""
+        found = []
+        for entry in reversed(self.entries):
+            if len(found) >= limit:
+                break
+            if entry.parts and (room is None or room in entry.rooms):
+                found.append(entry)
+
+        return found[::-1]
+
+    def _evict(self, current: ReplayEntry):
+        """Drop the oldest messages until the cache is within its limits, sparing 'current'"""
+        while len(self.entries) > self.cfg.max_messages or self.total_bytes > self.cfg.max_bytes:
+            oldest = next((entry for entry in self.entries if entry is not current), None)
+            if oldest is None:
+                break
+
+            self._drop(oldest)
+            metrics.count(metrics.REPLAY_EVICTED)
+
+    def _drop(self, entry: ReplayEntry):
+        self.entries.remove(entry)
+        self.total_bytes -= entry.size
+        for path, _ in entry.parts:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                logger.debug("Replay file was already removed: %s", path)
+
+
+REPLAY = ReplayCache()
+
+
+def setup_replay(cfg: Replay, clean: bool = False):
+    """Configure the replay cache, emptying it if 'clean' is set"""
+    REPLAY.configure(cfg, clean)
+
+
+async def play_replay(entries: List[ReplayEntry], cfg: Config, room: Optional[Room] = None):
+    """
+    Play cached messages, each in the rooms where it was first played (or else only in
+    'room', if given).
+    """
+    for entry in entries:
+        if room is not None:
+            outputs = [room.audio]
+        else:
+            rooms = [cfg.get_room(name) for name in entry.rooms]
+            outputs = [found.audio for found in rooms if found is not None]
+            outputs = outputs or [cfg.get_room().audio]
+
+        logger.info("Replaying %s", entry)
+        metrics.count(metrics.REPLAY_PLAYS, attributes={"kind": entry.kind})
+        for path, volume in entry.parts:
+            # The entry can be evicted while an earlier one is still playing.
+            if os.path.exists(path):
+                await gather(*[playback_ogg(path, output, volume) for output in outputs])
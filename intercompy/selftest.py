@@ -1,9 +1,26 @@
 """
 Run various kinds of self-test on an installation environment.
 """
-from asyncio import gather, new_event_loop, set_event_loop
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+from asyncio import gather, iscoroutine, new_event_loop, set_event_loop
+from time import monotonic, perf_counter
+from typing import Callable, Dict, Optional
 
-from intercompy.config import Config
+from intercompy import fakegpio
+from intercompy.config import Audio, Config, Room, BUTTONS_BACKEND_FAKE
+
+logger = logging.getLogger(__name__)
+
+TTS_SAMPLE_TEXT = "Text from: Someone. Message reads: Dinner is ready. STOP."
+
+
+class SelfTestError(Exception):
+    """A self-test step could not be carried out"""
 
 
 def test_gpio(cfg: Config):
@@ -12,9 +29,293 @@ def test_gpio(cfg: Config):
     from intercompy.gpio import init_pins, listen_for_pins
 
     print("Setting up hardware buttons")
-    init_pins(cfg.rolodex)
+    init_pins(cfg)
+
+    if cfg.buttons.backend == BUTTONS_BACKEND_FAKE:
+        threading.Thread(target=_simulate_presses, daemon=True).start()
 
     loop = new_event_loop()
     set_event_loop(loop)
     gather(listen_for_pins(None, cfg, loop))
     loop.run_forever()
+
+
+def _simulate_presses():
+    """With the fake GPIO backend, treat each pin number typed on stdin as a button press"""
+    print("Fake GPIO: type a pin number and press enter to push that button.")
+    for line in sys.stdin:
+        line = line.strip()
+        if not line.isdigit():
+            continue
+
+        pin = int(line)
+        fakegpio.press(pin)
+        threading.Timer(0.5, fakegpio.release, (pin,)).start()
+
+
+def test_audio(
+        cfg: Config, room_name: Optional[str] = None, iterations: int = 3,
+        output: Optional[str] = None
+) -> bool:
+    """
+    Measure audio latencies on this device: opening the input device, starting prompt
+    playback, the first chunk of a capture, endpointing / encoding a known synthetic
+    utterance, speech synthesis and speech recognition. Prints a report, writes it as JSON,
+    and returns whether every measurement ran and met its configured budget.
+    """
+    room = cfg.get_room(room_name)
+    if room is None:
+        raise ValueError(f"Unknown room: {room_name}. Rooms: {', '.join(cfg.rooms)}")
+
+    probe = LatencyProbe(iterations)
+    loop = new_event_loop()
+    set_event_loop(loop)
+    try:
+        loop.run_until_complete(_measure_audio(probe, room))
+    finally:
+        loop.close()
+
+    report = probe.report(cfg.selftest.budgets)
+    report.update({
+        "host": platform.node(),
+        "room": room.name,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    })
+
+    print(format_latency_report(report))
+
+    output = output or cfg.selftest.output
+    if output:
+        with open(output, "w", encoding="utf-8") as fhandle:
+            json.dump(report, fhandle, indent=2)
+        print(f"Latency report written to: {output}")
+
+    return report["passed"]
+
+
+class LatencyProbe:
+    """Time each step a number of times, remembering the results and any failures"""
+
+    def __init__(self, iterations: int):
+        self.iterations = max(iterations, 1)
+        self.samples: Dict[str, list] = {}
+        self.errors: Dict[str, str] = {}
+
+    async def measure(self, name: str, func: Callable):
+        """
+        Run 'func' (a function or coroutine function) repeatedly. If it returns a number, that
+        is taken as its own measurement in milliseconds; otherwise the call is timed.
+        """
+        print(f"Measuring: {name}")
+        samples = []
+        try:
+            for _ in range(self.iterations):
+                start = perf_counter()
+                result = func()
+                if iscoroutine(result):
+                    result = await result
+                elapsed = (perf_counter() - start) * 1000.0
+                samples.append(float(result) if isinstance(result, (int, float)) else elapsed)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error("Self-test step %s failed: %s", name, error)
+            self.errors[name] = f"{type(error).__name__}: {error}"
+            return
+
+        self.samples[name] = samples
+
+    def report(self, budgets: Dict[str, float]) -> dict:
+        """Summarize the measurements and check them against the budgets (by median)"""
+        # pylint: disable=import-outside-toplevel
+        from intercompy.bench import summarize
+
+        results = {name: summarize(samples) for name, samples in self.samples.items()}
+
+        checks = {}
+        for name, budget in budgets.items():
+            if name in results:
+                median = results[name]["median_ms"]
+                checks[name] = {"budget_ms": budget, "median_ms": median, "ok": median <= budget}
+            elif name not in self.errors:
+                logger.warning("No measurement named '%s'; its budget is ignored", name)
+
+        return {
+            "iterations": self.iterations,
+            "results": results,
+            "errors": self.errors,
+            "budgets": checks,
+            "passed": not self.errors and all(check["ok"] for check in checks.values()),
+        }
+
+
+def format_latency_report(report: dict) -> str:
+    """Render a latency report as a table"""
+    lines = [f"{'measurement':<16} {'median':>10} {'max':>10} {'budget':>10}  result"]
+    for name, summary in report["results"].items():
+        check = report["budgets"].get(name)
+        budget = f"{check['budget_ms']:.0f}ms" if check else "-"
+        result = ("OK" if check["ok"] else "OVER BUDGET") if check else ""
+        lines.append(
+            f"{name:<16} {summary['median_ms']:>8.1f}ms {summary['max_ms']:>8.1f}ms "
+            f"{budget:>10}  {result}"
+        )
+
+    for name, error in report["errors"].items():
+        lines.append(f"{name:<16} {'FAILED':>10}  {error}")
+
+    lines.append("PASSED" if report["passed"] else "FAILED")
+    return "\n".join(lines)
+
+
+async def _measure_audio(probe: LatencyProbe, room: Room):
+    # pylint: disable=import-outside-toplevel
+    from intercompy import audio
+
+    cfg = room.audio
+    input_info = {}
+    await probe.measure("device-open", lambda: _open_device(cfg, input_info))
+
+    try:
+        prompt = audio.record_prompt(audio.SND_INTERCOM_ONLINE, cfg)
+    except Exception as error:  # pylint: disable=broad-except
+        probe.errors["prompt-start"] = f"{type(error).__name__}: {error}"
+    else:
+        await probe.measure("prompt-start", lambda: _playback_start(prompt, cfg))
+
+    await probe.measure("capture", lambda: _first_chunk(cfg))
+
+    # Trim, encode and transcribe a known utterance at the device's rate and channel count, so
+    # the results are comparable between units regardless of what the microphone hears.
+    raw = _synthetic_recording(input_info)
+    trimmed = []
+    await probe.measure("trim", lambda: trimmed.append(_endpoint(raw, cfg)))
+
+    encoded = []
+
+    async def encode():
+        encoded.append(await audio.encode_ogg(trimmed[-1], cfg))
+
+    if trimmed:
+        await probe.measure("encode", encode)
+
+    for engine, func in _tts_engines().items():
+        await probe.measure(f"tts.{engine}", lambda func=func: _synthesize(func, cfg))
+
+    if encoded:
+        await probe.measure("stt", lambda: audio.speech_to_text(encoded[-1]))
+
+
+def _open_device(cfg: Audio, input_info: dict):
+    """
+    Find the input device and open a stream on it, the way a capture does. The device's
+    details are saved in 'input_info'.
+    """
+    # pylint: disable=import-outside-toplevel,protected-access
+    from intercompy import audio
+
+    pyaudio = audio.PyAudio()
+    try:
+        info = audio._detect_input(pyaudio, cfg)
+        if info is None:
+            raise SelfTestError("Cannot find valid input!")
+
+        stream = pyaudio.open(
+            format=audio.WAV_FORMAT,
+            channels=min(int(info.get("maxInputChannels")), 2),
+            rate=int(info.get("defaultSampleRate")),
+            input_device_index=int(info.get("index")),
+            input=True,
+            frames_per_buffer=audio.WAV_CHUNK_SIZE,
+        )
+        stream.close()
+        input_info.update(info)
+    finally:
+        pyaudio.terminate()
+
+
+async def _playback_start(filename: str, cfg: Audio) -> float:
+    """
+    Play a file, returning the milliseconds until VLC reports that it is playing. Waits for
+    playback to finish before returning.
+    """
+    # pylint: disable=import-outside-toplevel
+    from intercompy.audio import playback_ogg
+
+    started = monotonic()
+    latency = []
+    await playback_ogg(
+        filename, cfg, on_started=lambda: latency.append((monotonic() - started) * 1000.0)
+    )
+
+    if not latency:
+        raise SelfTestError(f"Playback of {filename} did not start")
+
+    return latency[0]
+
+
+async def _first_chunk(cfg: Audio) -> float:
+    """
+    Start a capture through the normal capture path, stopping after the first chunk. Returns
+    the milliseconds from starting the capture to that first chunk of audio.
+    """
+    # pylint: disable=import-outside-toplevel
+    from intercompy.audio import capture_voice
+
+    started = monotonic()
+    first_chunk = []
+
+    async def stop() -> bool:
+        # Called after each chunk is read
+        first_chunk.append(monotonic())
+        return True
+
+    await capture_voice(cfg, stop)
+    if not first_chunk:
+        raise SelfTestError("No audio was captured")
+
+    return (first_chunk[0] - started) * 1000.0
+
+
+def _synthetic_recording(input_info: dict):
+    """The known utterance, as an untrimmed recording in the input device's format"""
+    # pylint: disable=import-outside-toplevel
+    from intercompy.audio import Recording
+    from intercompy.testsignal import DEFAULT_RATE, synthetic_speech, to_channels
+
+    rate = int(input_info.get("defaultSampleRate") or DEFAULT_RATE)
+    channels = min(int(input_info.get("maxInputChannels") or 1), 2)
+    data = to_channels(synthetic_speech(rate), channels)
+    return Recording({"defaultSampleRate": rate}, channels, data.itemsize, data)
+
+
+def _endpoint(recording, cfg: Audio):
+    """
+    Run a recording through the configured endpointer chunk by chunk, as a capture does, and
+    return the trimmed recording.
+    """
+    # pylint: disable=import-outside-toplevel
+    from intercompy.audio import WAV_CHUNK_SIZE, Recording, new_endpointer
+
+    rate = int(recording.input_info.get("defaultSampleRate"))
+    endpointer = new_endpointer(cfg, rate, recording.channels)
+    step = WAV_CHUNK_SIZE * recording.channels
+    for offset in range(0, len(recording.data), step):
+        if endpointer.feed(recording.data[offset:offset + step]):
+            break
+
+    return Recording(recording.input_info, recording.channels, recording.sample_width,
+                     endpointer.trim(recording.data))
+
+
+def _synthesize(engine: Callable, cfg: Audio):
+    # pylint: disable=import-outside-toplevel
+    from intercompy.spool import spool_file
+
+    with spool_file("intercom.selftest.", ".ogg") as fname:
+        engine(TTS_SAMPLE_TEXT, fname, cfg)
+
+
+def _tts_engines() -> Dict[str, Callable]:
+    # pylint: disable=import-outside-toplevel,protected-access
+    from intercompy import audio
+
+    return {"gtts": audio._synthesize}
@@ -0,0 +1,87 @@
+"""
+Telegram session storage.
+
+By default the client is built from the exported session string, which Pyrogram keeps in an
+in-memory store: every start begins with no known peers and no update state. With
+'session-storage: file', the store is a file under the state directory instead, so peers
+resolved and updates seen before a restart are still there after it. An existing session
+string seeds the file store, so switching over doesn't need a new login.
+"""
+import logging
+import os
+from asyncio import gather
+from pathlib import Path
+from typing import List, Union
+
+from pyrogram import Client
+from pyrogram.storage import FileStorage, MemoryStorage
+
+from intercompy.config import Config, Telegram
+
+logger = logging.getLogger(__name__)
+
+# Everything in a session string; the peer cache and update state are left to accumulate.
+SESSION_FIELDS = ("dc_id", "api_id", "test_mode", "auth_key", "date", "user_id", "is_bot")
+
+
+def session_client(cfg: Telegram) -> Client:
+    """Build a Pyrogram client over the configured kind of session storage"""
+    if cfg.uses_file_storage:
+        return Client(
+            cfg.session_db_name, api_id=cfg.api_id, api_hash=cfg.api_hash,
+            workdir=cfg.session_dir,
+        )
+
+    return Client(cfg.account_name, session_string=cfg.session)
+
+
+async def seed_file_storage(cfg: Telegram) -> bool:
+    """
+    Create the file-backed session store from the session string, if the store doesn't exist
+    yet. Returns True if a store was created.
+    """
+    if not cfg.uses_file_storage or os.path.exists(cfg.session_db_file) or not cfg.session:
+        return False
+
+    source = MemoryStorage(cfg.session_db_name, cfg.session)
+    target = FileStorage(cfg.session_db_name, Path(cfg.session_dir))
+    await source.open()
+    await target.open()
+    try:
+        for field in SESSION_FIELDS:
+            await getattr(target, field)(await getattr(source, field)())
+        await target.save()
+    finally:
+        await target.close()
+        await source.close()
+
+    logger.info("Seeded Telegram session storage at %s", cfg.session_db_file)
+    return True
+
+
+def _peer_targets(cfg: Config) -> List[Union[str, int]]:
+    targets = [cfg.telegram.chat] if cfg.telegram.chat else []
+    for entry in cfg.rolodex.entries():
+        for target in entry.targets:
+            if target not in targets:
+                targets.append(target)
+
+    return targets
+
+
+async def warm_peer_cache(app: Client, cfg: Config):
+    """
+    Resolve the default chat and every rolodex target up front, so the first message after
+    boot doesn't wait on peer lookups. With file storage most of these are already cached.
+    """
+    targets = _peer_targets(cfg)
+    results = await gather(
+        *[app.resolve_peer(target) for target in targets], return_exceptions=True
+    )
+    failed = [
+        target for target, result in zip(targets, results) if isinstance(result, Exception)
+    ]
+    for target in failed:
+        logger.warning("Unable to resolve Telegram peer: %s", target)
+
+    logger.debug("Resolved %d of %d Telegram peers", len(targets) - len(failed), len(targets))
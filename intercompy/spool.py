@@ -0,0 +1,85 @@
+"""
+A managed spool directory for the media files that can't be handled in memory. Outbound voice
+notes and speech-recognition chunks stay in memory; inbound voice and synthesized speech are
+written here because VLC plays from a path.
+
+The spool lives on a tmpfs by default, so these short-lived files never touch the SD card. It
+is emptied at startup (removing anything left behind by a crash), each file is removed as soon
+as it's no longer needed, and new files are refused once the spool reaches its size cap.
+"""
+import logging
+import os
+from contextlib import contextmanager
+from tempfile import mkstemp
+from typing import Iterator
+
+from intercompy import metrics
+from intercompy.config import Spool
+
+logger = logging.getLogger(__name__)
+
+SPOOL = Spool()
+
+
+class SpoolFullError(Exception):
+    """Raised when a new spool file would exceed the configured size cap"""
+
+
+def setup_spool(cfg: Spool, clean: bool = False):
+    """
+    Create the spool directory. With 'clean' (only when the intercom itself starts), also
+    remove anything left over from a previous run.
+    """
+    global SPOOL  # pylint: disable=global-statement
+    SPOOL = cfg
+
+    os.makedirs(cfg.spool_dir, exist_ok=True)
+    if not clean:
+        return
+
+    stale = 0
+    with os.scandir(cfg.spool_dir) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                os.remove(entry.path)
+                stale += 1
+
+    logger.info("Spooling media in %s (removed %d leftover files)", cfg.spool_dir, stale)
+
+
+def spool_usage() -> int:
+    """Total size of the files currently in the spool, in bytes"""
+    try:
+        with os.scandir(SPOOL.spool_dir) as entries:
+            return sum(
+                entry.stat(follow_symlinks=False).st_size for entry in entries
+                if entry.is_file(follow_symlinks=False)
+            )
+    except FileNotFoundError:
+        return 0
+
+
+@contextmanager
+def spool_file(prefix: str, suffix: str) -> Iterator[str]:
+    """
+    Reserve a file in the spool, yielding its path. The file is removed on exit, whether or
+    not the block succeeded.
+    """
+    usage = spool_usage()
+    if usage >= SPOOL.max_bytes:
+        metrics.count(metrics.SPOOL_REJECTED)
+        raise SpoolFullError(
+            f"Spool {SPOOL.spool_dir} is full ({usage} of {SPOOL.max_bytes} bytes)"
+        )
+
+    os.makedirs(SPOOL.spool_dir, exist_ok=True)
+    fd, path = mkstemp(prefix=prefix, suffix=suffix, dir=SPOOL.spool_dir)
+    os.close(fd)
+
+    try:
+        yield path
+    finally:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            logger.debug("Spool file was already removed: %s", path)
@@ -0,0 +1,68 @@
+"""
+A known test signal for the audio pipeline: synthetic PCM shaped like a short spoken message.
+The benchmarks, the fake microphone and the audio self-test all measure against it, so their
+results don't depend on what a microphone happens to hear.
+"""
+import math
+import random
+from array import array
+from typing import NamedTuple
+
+DEFAULT_RATE = 16000
+SILENCE_AMPLITUDE = 60
+SPEECH_AMPLITUDE = 9000
+
+
+class SpeechShape(NamedTuple):
+    """The timing of a synthetic utterance, in seconds"""
+
+    bursts: int = 3
+    burst_seconds: float = 0.8
+    gap_seconds: float = 0.3
+    lead_seconds: float = 0.5
+    tail_seconds: float = 2.0
+
+
+def synthetic_speech(
+        rate: int = DEFAULT_RATE, shape: SpeechShape = SpeechShape(), seed: int = 42
+) -> array:
+    """
+    Generate mono, signed 16-bit PCM resembling an utterance: low-level noise, then bursts of
+    amplitude-modulated harmonics separated by short pauses, then trailing silence.
+    """
+    rng = random.Random(seed)
+    samples = array("h")
+
+    def silence(seconds: float):
+        for _ in range(int(rate * seconds)):
+            samples.append(rng.randint(-SILENCE_AMPLITUDE, SILENCE_AMPLITUDE))
+
+    def burst(seconds: float):
+        pitch = rng.uniform(110.0, 220.0)
+        count = int(rate * seconds)
+        for i in range(count):
+            syllables = 0.6 + 0.4 * math.sin(2 * math.pi * 4 * i / rate)
+            envelope = math.sin(math.pi * i / count) * syllables
+            phase = 2 * math.pi * pitch * i / rate
+            value = math.sin(phase) + 0.5 * math.sin(2 * phase) + 0.25 * math.sin(3 * phase)
+            samples.append(int(SPEECH_AMPLITUDE * envelope * value / 1.75))
+
+    silence(shape.lead_seconds)
+    for idx in range(shape.bursts):
+        burst(shape.burst_seconds)
+        if idx < shape.bursts - 1:
+            silence(shape.gap_seconds)
+    silence(shape.tail_seconds)
+
+    return samples
+
+
+def to_channels(mono: array, channels: int) -> array:
+    """Interleave a mono signal into the given number of identical channels"""
+    if channels == 1:
+        return mono
+
+    out = array("h")
+    for sample in mono:
+        out.extend([sample] * channels)
+    return out
@@ -1,25 +1,147 @@
-"""Text enhancement and analysis utilities"""
+"""
+Text enhancement and analysis utilities.
+
+Inbound text is normalized before it goes to text-to-speech: links become "link", emoji are
+named (or dropped), runs of punctuation and long digit strings are tidied up, and very long
+messages are cut short. Every character handed to gTTS costs synthesis time and playback time,
+so the rules are compiled once at import, and the sentence tokenizer is loaded once and reused.
+"""
+import re
+import unicodedata
+from functools import lru_cache
 from logging import getLogger
+from typing import Callable, List
 
 import nltk
+import opentelemetry.trace
+
+from intercompy.config import EMOJI_REMOVE, Audio
 
-from intercompy.config import Audio
+try:
+    # NLTK 3.9 and later load Punkt from plain-text parameters ('punkt_tab')
+    from nltk.tokenize.punkt import PunktTokenizer
+except ImportError:  # pragma: no cover - older NLTK
+    PunktTokenizer = None
 
 logger = getLogger(__name__)
 
+PUNKT_RESOURCE = "punkt_tab" if PunktTokenizer is not None else "punkt"
+PUNKT_LANGUAGE = "english"
+
+LINK = "link"
+TRUNCATED = "Message truncated."
+
+NUMBER_GROUP_MIN_DIGITS = 7
+NUMBER_GROUP_SIZE = 3
+
+URL_RE = re.compile(
+    r"\b(?:https?://|www\.)[^\s<>\"]*[^\s<>\"'.,;:!?)\]}]", re.IGNORECASE
+)
+EMOJI_RE = re.compile(
+    "[\U0001F000-\U0001FAFF\u2300-\u23FF\u2600-\u27BF\u2B00-\u2BFF"
+    "\u200D\uFE0E\uFE0F\u20E3]+"
+)
+REPEATED_PUNCTUATION_RE = re.compile(r"([!?.,;:])[!?.,;:]+")
+REPEATED_SYMBOL_RE = re.compile(r"([-_*=~#+<>/\\|])\1{2,}")
+# Whole digit runs only: "555 1234567" is grouped, the fraction in "3.14159265" is not.
+LONG_NUMBER_RE = re.compile(r"(?<![\d.,])\d{%d,}(?!\d)" % NUMBER_GROUP_MIN_DIGITS)
+WHITESPACE_RE = re.compile(r"\s+")
+SPACE_BEFORE_PUNCTUATION_RE = re.compile(r"\s+(?=[!?.,;:])")
+# The fallback splitter: end punctuation, except after the commonest abbreviations
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])(?<!\b(?:Mr|Ms|Dr|St|Jr|Sr)\.)(?<!\bMrs\.)\s+")
+
 
 def setup_text_analysis():
-    """Setup natural language processing"""
-    nltk.download("punkt")
+    """Setup natural language processing, fetching the tokenizer data only if it's missing"""
+    try:
+        nltk.data.find(f"tokenizers/{PUNKT_RESOURCE}")
+    except LookupError:
+        if not nltk.download(PUNKT_RESOURCE, quiet=True):
+            logger.warning("Unable to download NLTK '%s' data", PUNKT_RESOURCE)
+
+    _sentence_tokenizer()
+
+
+@lru_cache(maxsize=None)
+def _sentence_tokenizer() -> Callable[[str], List[str]]:
+    """Load the Punkt sentence tokenizer once, or fall back to splitting on end punctuation"""
+    try:
+        if PunktTokenizer is not None:
+            return PunktTokenizer(PUNKT_LANGUAGE).tokenize
+
+        return nltk.data.load(f"tokenizers/punkt/{PUNKT_LANGUAGE}.pickle").tokenize
+    except LookupError:
+        logger.warning("NLTK '%s' data is not available. Splitting sentences on punctuation.",
+                       PUNKT_RESOURCE)
+        return SENTENCE_END_RE.split
+
+
+@lru_cache(maxsize=256)
+def _emoji_name(char: str) -> str:
+    name = unicodedata.name(char, "")
+    # Joiners, variation selectors, skin tones and flag letters only modify their neighbours.
+    if not name or name.startswith(("ZERO WIDTH", "VARIATION SELECTOR", "EMOJI MODIFIER",
+                                    "REGIONAL INDICATOR", "COMBINING")):
+        return ""
+
+    return name.lower()
+
+
+def _replace_emoji(match, remove: bool) -> str:
+    if remove:
+        return " "
+
+    names = []
+    for char in match.group(0):
+        name = _emoji_name(char)
+        if name and name not in names:
+            names.append(name)
+
+    return f" {', '.join(names)} " if names else " "
+
+
+def _group_digits(match) -> str:
+    """Read long digit strings (phone numbers, ids) in small groups, rather than as a huge number"""
+    digits = match.group(0)
+    groups = [digits[i:i + NUMBER_GROUP_SIZE] for i in range(0, len(digits), NUMBER_GROUP_SIZE)]
+    if len(groups) > 1 and len(groups[-1]) == 1:
+        groups[-2:] = [groups[-2] + groups[-1]]
+
+    return " ".join(groups)
+
+
+def _truncate(txt: str, max_length: int) -> str:
+    if len(txt) <= max_length:
+        return txt
+
+    cut = txt.rfind(" ", 0, max_length)
+    return f"{txt[:cut if cut > 0 else max_length].rstrip(' ,;:')}. {TRUNCATED}"
+
+
+def normalize_for_speech(txt: str, cfg: Audio) -> str:
+    """Rewrite a message into shorter, cleaner input for text-to-speech"""
+    result = URL_RE.sub(LINK, txt)
+    remove = cfg.text_msg_emoji == EMOJI_REMOVE
+    result = EMOJI_RE.sub(lambda match: _replace_emoji(match, remove), result)
+    result = REPEATED_PUNCTUATION_RE.sub(r"\1", result)
+    result = REPEATED_SYMBOL_RE.sub(" ", result)
+    result = LONG_NUMBER_RE.sub(_group_digits, result)
+    result = WHITESPACE_RE.sub(" ", result).strip()
+    result = SPACE_BEFORE_PUNCTUATION_RE.sub("", result)
+
+    return _truncate(result, cfg.text_msg_max_length)
 
 
 async def format_inbound_message_for_speech(txt: str, cfg: Audio) -> str:
     """Insert any quirky text modifications, such as to make the message sound like a telegram"""
-    result = txt
+    result = normalize_for_speech(txt, cfg)
     if cfg.text_msg_line_ending:
-        # tokenizer = nltk_load("tokenizers/punkt/english.pickle")
         sep = f"{cfg.text_msg_line_ending}\n"
-        result = sep.join(nltk.sent_tokenize(txt))
+        result = sep.join(_sentence_tokenizer()(result))
 
+    opentelemetry.trace.get_current_span().set_attributes({
+        "text.original-length": len(txt),
+        "text.spoken-length": len(result),
+    })
     logger.info("Formatted message is: '%s'", result)
     return result
@@ -1,33 +1,81 @@
 """Setup observability stuff"""
+from functools import wraps
+from inspect import iscoroutinefunction
 
 import opentelemetry
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
 from opentelemetry.instrumentation.requests import RequestsInstrumentor
+from opentelemetry.sdk.resources import Resource
 from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
+from opentelemetry.sdk.trace.export import (
+    BatchSpanProcessor,
+    ConsoleSpanExporter,
+    SpanExporter,
+)
+from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
 
-from intercompy.config import Tracing
+from intercompy.config import Tracing, EXPORTER_CONSOLE, EXPORTER_FILE, OTLP_TRACES
+from intercompy.exporters import JsonLinesSpanExporter
 
 # pylint: disable=global-at-module-level
 # pylint: disable=global-statement
 TRACING_CONFIG = None
+TRACING_ENABLED = False
+TRACER = None
 
 
 def setup_tracing(cfg: Tracing):
     """
     Setup the Opentelemetry tracing system, and save the configuration globally for the @trace
-    decorator to use later.
+    decorator to use later. When tracing is disabled (or the exporter is 'none'), nothing is
+    installed and @trace becomes a pass-through. Spans are buffered in a bounded queue, so
+    telemetry has a fixed memory ceiling even when the exporter can't keep up.
     """
-    provider = TracerProvider()
-    processor = BatchSpanProcessor(OTLPSpanExporter(endpoint="https://api.honeycomb.io"))
+    global TRACING_CONFIG, TRACING_ENABLED, TRACER
+    TRACING_CONFIG = cfg
+
+    if not cfg.enabled:
+        TRACING_ENABLED = False
+        return
+
+    resource = Resource.create({
+        "service.name": "intercompy",
+        "intercom.name": cfg.intercom_name or "unknown",
+    })
+
+    # Head sampling: the decision is made when a root span starts, and inherited by children.
+    sampler = ParentBased(TraceIdRatioBased(cfg.sample_rate))
+
+    provider = TracerProvider(resource=resource, sampler=sampler)
+    processor = BatchSpanProcessor(
+        _span_exporter(cfg),
+        max_queue_size=cfg.max_queue_size,
+        max_export_batch_size=cfg.max_export_batch_size,
+        schedule_delay_millis=cfg.export_delay_ms,
+        export_timeout_millis=cfg.export_timeout_ms,
+    )
     provider.add_span_processor(processor)
     opentelemetry.trace.set_tracer_provider(provider)
 
-    global TRACING_CONFIG
-    TRACING_CONFIG = cfg
-
     RequestsInstrumentor().instrument()
 
+    TRACER = get_tracer()
+    TRACING_ENABLED = True
+
+
+def _span_exporter(cfg: Tracing) -> SpanExporter:
+    """Build the configured span exporter"""
+    if cfg.exporter == EXPORTER_FILE:
+        print(f"Writing traces to: {cfg.file}")
+        return JsonLinesSpanExporter(cfg.file, cfg.file_max_bytes, cfg.file_backups)
+
+    if cfg.exporter == EXPORTER_CONSOLE:
+        return ConsoleSpanExporter()
+
+    endpoint = cfg.otlp_endpoint(OTLP_TRACES)
+    print(f"Exporting traces to: {endpoint}")
+    return OTLPSpanExporter(endpoint=endpoint, timeout=max(cfg.export_timeout_ms // 1000, 1))
+
 
 def get_tracer():
     """Return a tracer that can be used to open spans for code blocks"""
@@ -35,15 +83,30 @@ def get_tracer():
 
 
 def trace(func):
-    """Decorator for tracing"""
+    """
+    Decorator for tracing. Works for both coroutine functions and plain functions; for
+    coroutines, the span covers the whole awaited call rather than just creating the coroutine.
+    """
+    name = func.__name__
+
+    if iscoroutinefunction(func):
 
+        @wraps(func)
+        async def async_wrapper_trace(*args, **kwargs):
+            if not TRACING_ENABLED:
+                return await func(*args, **kwargs)
+
+            with TRACER.start_as_current_span(name):
+                return await func(*args, **kwargs)
+
+        return async_wrapper_trace
+
+    @wraps(func)
     def wrapper_trace(*args, **kwargs):
-        """Create a new span with the """
-        tracer = get_tracer()
-        with tracer.start_as_current_span(func.__name__, attributes={
-            "service.name": "intercompy",
-            "intercom.name": TRACING_CONFIG.intercom_name
-        }):
+        if not TRACING_ENABLED:
+            return func(*args, **kwargs)
+
+        with TRACER.start_as_current_span(name):
             return func(*args, **kwargs)
 
     return wrapper_trace
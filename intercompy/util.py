@@ -7,6 +7,7 @@ from os import getenv
 from pyrogram import Client
 
 from intercompy.config import Config
+from intercompy.session import seed_file_storage, warm_peer_cache
 
 
 async def setup_session(cfg: Config):
@@ -16,6 +17,10 @@ async def setup_session(cfg: Config):
     api_id = getenv("API_ID") or tel.api_id
     api_hash = getenv("API_HASH") or tel.api_hash
 
+    if tel.uses_file_storage:
+        await setup_file_session(cfg, api_id, api_hash)
+        return
+
     app = Client(":memory:", api_id=api_id, api_hash=api_hash)
     await app.start()
     try:
@@ -24,3 +29,29 @@ async def setup_session(cfg: Config):
             fhandle.write(session)
     finally:
         await app.stop()
+
+
+async def setup_file_session(cfg: Config, api_id: str, api_hash: str):
+    """
+    Create the file-backed session store, seeding it from an existing session string or else
+    logging in interactively, then fill its peer cache with the rolodex targets.
+    """
+    tel = cfg.telegram
+    if await seed_file_storage(tel):
+        print(f"Copied the existing Telegram session into {tel.session_db_file}")
+
+    app = Client(tel.session_db_name, api_id=api_id, api_hash=api_hash, workdir=tel.session_dir)
+    await app.start()
+    try:
+        # Dialogs bring every recent chat's peer into the store, along with the update state.
+        async for _ in app.get_dialogs():
+            pass
+        await warm_peer_cache(app, cfg)
+
+        # Keep a session string alongside, so switching back to string storage still works.
+        with open(tel.session_file, "w", encoding="utf-8") as fhandle:
+            fhandle.write(await app.export_session_string())
+    finally:
+        await app.stop()
+
+    print(f"Telegram session storage is ready at {tel.session_db_file}")
@@ -0,0 +1,95 @@
+"""
+Detect callbacks that hold the asyncio event loop for too long.
+
+A heartbeat coroutine wakes up on a short, fixed interval and measures how late it was
+woken (the loop lag). A separate thread watches that heartbeat; when it stops beating for
+longer than the threshold, the thread captures the event loop thread's current stack, which
+points at whatever blocking call is holding the loop. Once the loop recovers, the stall is
+reported as a log warning, a span with the captured stack as an event, and a metric.
+"""
+import logging
+import sys
+import threading
+import time
+import traceback
+from asyncio import AbstractEventLoop, sleep
+from time import monotonic
+from typing import Optional
+
+from intercompy import metrics
+from intercompy.tracing import get_tracer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STALL_THRESHOLD_MS = 250
+HEARTBEAT_INTERVAL = 0.1
+
+
+class Watchdog:
+    """Measure event loop lag continuously and report the stack of any stall"""
+
+    def __init__(self, loop: AbstractEventLoop, threshold_ms: int = DEFAULT_STALL_THRESHOLD_MS):
+        self.loop = loop
+        self.threshold = threshold_ms / 1000.0
+        self.interval = min(HEARTBEAT_INTERVAL, self.threshold / 2)
+        self.last_beat = monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.stall_stack: Optional[str] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start the heartbeat on the loop and the monitoring thread"""
+        print(f"Event loop watchdog enabled (threshold: {self.threshold * 1000:.0f}ms)")
+        self.loop.create_task(self._heartbeat())
+        threading.Thread(target=self._monitor, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        """Stop monitoring"""
+        self._stopped.set()
+
+    async def _heartbeat(self):
+        self.loop_thread_id = threading.get_ident()
+        while not self._stopped.is_set():
+            expected = monotonic() + self.interval
+            await sleep(self.interval)
+
+            now = monotonic()
+            lag = max(now - expected, 0.0)
+            self.last_beat = now
+
+            metrics.record_duration(metrics.LOOP_LAG, lag)
+            if lag >= self.threshold:
+                self._report(lag)
+            else:
+                self.stall_stack = None
+
+    def _monitor(self):
+        """Runs on its own thread, so it can look at the loop while the loop is stuck"""
+        captured_for = None
+        while not self._stopped.wait(self.interval / 2):
+            beat = self.last_beat
+            if monotonic() - beat < self.threshold or captured_for == beat:
+                continue
+
+            # First time this stall crossed the threshold: grab the loop thread's stack now,
+            # while the offending call is still on it.
+            captured_for = beat
+            # pylint: disable=protected-access
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is not None:
+                self.stall_stack = "".join(traceback.format_stack(frame))
+
+    def _report(self, lag: float):
+        stack = self.stall_stack or "<stack not captured>"
+        self.stall_stack = None
+
+        logger.warning("Event loop was blocked for %.0fms. Stack at the time:\n%s",
+                       lag * 1000, stack)
+        metrics.count(metrics.LOOP_STALLS)
+
+        # Backdate the span to when the stall began, so it lines up with other traces.
+        start_ns = time.time_ns() - int(lag * 1e9)
+        span = get_tracer().start_span("event-loop.stall", start_time=start_ns)
+        span.set_attribute("loop.lag-ms", int(lag * 1000))
+        span.add_event("blocked-stack", {"stack": stack})
+        span.end()